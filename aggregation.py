@@ -0,0 +1,230 @@
+import bisect
+import math
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+from peewee import Case, fn
+from peewee import Tuple as RowValue
+
+from const import *
+from database import ChartRecord, LocalChartStat, song_database
+from log import logger
+
+ChartKey = Tuple[int, int]  # (song_id, level)
+
+# 按FC_STATUS顺序把fc_status映射为等级，便于在SQL中取最高FC状态
+_FC_RANK = Case(
+    ChartRecord.fc_status,
+    [(status, rank) for rank, status in enumerate(FC_STATUS) if status],
+    0,
+)
+
+
+class ChartAggregate:
+    """单张谱面的在线统计：达成率的均值与方差（Welford算法）以及评级、FC分布"""
+
+    __slots__ = ("sample_num", "mean", "m2", "dist", "fc_dist")
+
+    def __init__(self, sample_num=0, mean=0.0, m2=0.0, dist=None, fc_dist=None):
+        self.sample_num = sample_num
+        self.mean = mean
+        self.m2 = m2
+        self.dist = dist or [0] * len(ACHIEVEMENT_GRADE_BOUNDS)
+        self.fc_dist = fc_dist or [0] * len(FC_STATUS)
+
+    def add(self, achievement: float, fc_rank: int) -> None:
+        self.sample_num += 1
+        delta = achievement - self.mean
+        self.mean += delta / self.sample_num
+        self.m2 += delta * (achievement - self.mean)
+        self.dist[_grade_of(achievement)] += 1
+        self.fc_dist[fc_rank] += 1
+
+    def remove(self, achievement: float, fc_rank: int) -> None:
+        if self.sample_num <= 1:
+            self.__init__()
+            return
+        delta = achievement - self.mean
+        self.mean = (self.mean * self.sample_num - achievement) / (self.sample_num - 1)
+        self.m2 = max(self.m2 - delta * (achievement - self.mean), 0.0)
+        self.sample_num -= 1
+        self.dist[_grade_of(achievement)] -= 1
+        self.fc_dist[fc_rank] -= 1
+
+    @property
+    def std_dev(self) -> float:
+        return math.sqrt(self.m2 / self.sample_num) if self.sample_num else 0.0
+
+    def to_dict(self) -> dict:
+        return {
+            "sample_num": self.sample_num,
+            "avg_achievement": round(self.mean, 5),
+            "std_dev": round(self.std_dev, 5),
+            "achievement_dist": self.dist,
+            "fc_dist": self.fc_dist,
+        }
+
+
+def _grade_of(achievement: float) -> int:
+    return bisect.bisect_right(ACHIEVEMENT_GRADE_BOUNDS, achievement) - 1
+
+
+class ChartStatAggregator:
+    """
+    社区谱面统计：每位玩家在每张谱面上以最好成绩计一个样本。
+    玩家成绩更新时移除旧的最好成绩、加入新的最好成绩。
+    LocalChartStat为唯一的数据来源：写入时锁定相关的行并在其最新值上增减，
+    各worker内存中的副本只用于查询，定期从数据库重新加载。
+    """
+
+    def __init__(self):
+        self._stats: Dict[ChartKey, ChartAggregate] = {}
+        self._loaded = False
+
+    def _ensure_loaded(self) -> None:
+        if not self._loaded:
+            self.reload()
+
+    def reload(self) -> None:
+        stats = {
+            (row.song_id, row.level): self._from_row(row)
+            for row in LocalChartStat.select()
+        }
+        self._stats = stats  # 整体替换，查询方不会看到加载了一半的结果
+        self._loaded = True
+
+    @staticmethod
+    def _from_row(row: LocalChartStat) -> ChartAggregate:
+        return ChartAggregate(
+            row.sample_num,
+            float(row.mean),
+            float(row.m2),
+            row.achievement_dist,
+            row.fc_dist,
+        )
+
+    @staticmethod
+    def player_best_records(player_id: str) -> Dict[ChartKey, Tuple[float, int]]:
+        query = (
+            ChartRecord.select(
+                ChartRecord.song_id,
+                ChartRecord.level,
+                fn.MAX(ChartRecord.achievement),
+                fn.MAX(_FC_RANK),
+            )
+            .where(ChartRecord.player_id == player_id)
+            .group_by(ChartRecord.song_id, ChartRecord.level)
+            .tuples()
+        )
+        return {
+            (song_id, level): (float(achievement), int(fc_rank))
+            for song_id, level, achievement, fc_rank in query
+        }
+
+    def apply(
+        self,
+        previous_best: Dict[ChartKey, Tuple[float, int]],
+        records: np.ndarray,
+    ) -> None:
+        """previous_best为写入本次成绩前该玩家各谱面的最好成绩，records为本次获取的成绩"""
+        changes = {}
+        for song_id, level, achievement, fc in zip(
+            records["song_id"].tolist(),
+            records["level"].tolist(),
+            records["achievement"].tolist(),
+            records["fc"].tolist(),
+        ):
+            key = (song_id, level)
+            fc_rank = FC_STATUS.index(fc) if fc in FC_STATUS else 0
+            previous = previous_best.get(key)
+            if previous is not None:
+                achievement = max(achievement, previous[0])
+                fc_rank = max(fc_rank, previous[1])
+                if (achievement, fc_rank) == previous:
+                    continue
+            changes[key] = (previous, (achievement, fc_rank))
+        if not changes:
+            return
+        with song_database.atomic():
+            # 锁定涉及的行后在数据库中的最新值上增减，多个worker同时写入时不会互相覆盖
+            query = (
+                LocalChartStat.select()
+                .where(
+                    RowValue(LocalChartStat.song_id, LocalChartStat.level).in_(
+                        list(changes)
+                    )
+                )
+                .for_update()
+            )
+            current = {(row.song_id, row.level): self._from_row(row) for row in query}
+            for key, (previous, best) in changes.items():
+                aggregate = current.setdefault(key, ChartAggregate())
+                if previous is not None:
+                    aggregate.remove(*previous)
+                aggregate.add(*best)
+            self._write(current)
+        if self._loaded:
+            self._stats.update(current)
+
+    @staticmethod
+    def _write(stats: Dict[ChartKey, ChartAggregate]) -> None:
+        if not stats:
+            return
+        LocalChartStat.replace_many(
+            [
+                {
+                    "song_id": song_id,
+                    "level": level,
+                    "sample_num": aggregate.sample_num,
+                    "mean": aggregate.mean,
+                    "m2": aggregate.m2,
+                    "achievement_dist": aggregate.dist,
+                    "fc_dist": aggregate.fc_dist,
+                }
+                for (song_id, level), aggregate in stats.items()
+            ]
+        ).execute()
+
+    def get(self, song_id: int, level: int) -> Optional[dict]:
+        self._ensure_loaded()
+        aggregate = self._stats.get((song_id, level))
+        return aggregate.to_dict() if aggregate else None
+
+    def all(self) -> Dict[ChartKey, dict]:
+        self._ensure_loaded()
+        return {key: value.to_dict() for key, value in self._stats.items()}
+
+    def rebuild(self) -> None:
+        """从ChartRecord全量重建（仅在统计表为空时初始化使用）"""
+        logger.info("rebuilding local chart statistics")
+        stats: Dict[ChartKey, ChartAggregate] = {}
+        query = (
+            ChartRecord.select(
+                ChartRecord.song_id,
+                ChartRecord.level,
+                fn.MAX(ChartRecord.achievement),
+                fn.MAX(_FC_RANK),
+            )
+            .group_by(ChartRecord.player_id, ChartRecord.song_id, ChartRecord.level)
+            .tuples()
+            .iterator()
+        )
+        for song_id, level, achievement, fc_rank in query:
+            stats.setdefault((song_id, level), ChartAggregate()).add(
+                float(achievement), int(fc_rank)
+            )
+        with song_database.atomic():
+            keys = list(stats)
+            for i in range(0, len(keys), 1000):
+                self._write({key: stats[key] for key in keys[i : i + 1000]})
+        self._stats = stats
+        self._loaded = True
+
+    def initialize(self) -> None:
+        # 须在开始接收成绩写入前调用，否则写入的增量会在空表上计算
+        if LocalChartStat.select().exists() or not ChartRecord.select().exists():
+            return
+        self.rebuild()
+
+
+chart_stat_aggregator = ChartStatAggregator()
@@ -0,0 +1,117 @@
+"""
+冷启动导入耗时基准：在新的解释器中以 -X importtime 导入 main，取多次运行的中位数。
+另在新的解释器中从一份快照执行 sync_chart_data()，检查worker启动时的同步是否载入了延迟载入的模块。
+超出预算或延迟载入的模块被提前导入时以非零状态退出，可用于CI检查启动耗时回退。
+
+用法: python benchmarks/import_time.py [--runs 5] [--budget 600]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+# 只应在用到时才载入的模块
+LAZY_MODULES = ["scipy", "httpx", "uvicorn"]
+
+# 发布只含一张有统计数据谱面的快照后执行sync_chart_data，输出此时已载入的模块。
+# 歌曲搜索索引改从内存中的SQLite读取，不需要连接数据库
+SYNC_SCRIPT = """
+import sys
+import tempfile
+
+import numpy as np
+from peewee import SqliteDatabase
+
+import main
+import core
+from catalog import ChartCatalog
+from database import SongAlias, SongInfo
+from snapshot import snapshot_store
+
+db = SqliteDatabase(":memory:")
+db.bind([SongInfo, SongAlias])
+db.create_tables([SongInfo, SongAlias])
+arrays = {
+    name: np.zeros((1, *value.shape[1:]), dtype=value.dtype)
+    for name, value in ChartCatalog._empty_arrays().items()
+}
+arrays["has_stat"][:] = True
+snapshot_store.directory = tempfile.mkdtemp()
+snapshot_store.publish(
+    ChartCatalog(arrays),
+    {"best_fit": {"distribution": "lognorm", "params": [1.0, 0.0, 1.0]}},
+)
+assert core.sync_chart_data()
+print("\\n".join(sys.modules))
+"""
+
+
+def measure() -> tuple:
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", "import main"],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    modules = {}
+    for line in result.stderr.splitlines():
+        if not line.startswith("import time:") or "|" not in line:
+            continue
+        _, cumulative, name = line[len("import time:") :].split("|")
+        if cumulative.strip().isdigit():
+            modules[name.strip()] = int(cumulative) / 1000
+    return modules["main"], modules
+
+
+def modules_after_sync() -> list:
+    result = subprocess.run(
+        [sys.executable, "-c", SYNC_SCRIPT],
+        cwd=ROOT,
+        capture_output=True,
+        text=True,
+        check=True,
+    )
+    return result.stdout.splitlines()
+
+
+def _lazy(modules) -> list:
+    return sorted(
+        name
+        for name in modules
+        if any(name == i or name.startswith(i + ".") for i in LAZY_MODULES)
+    )
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=5)
+    parser.add_argument("--budget", type=float, default=600, help="毫秒")
+    args = parser.parse_args()
+
+    timings = []
+    for _ in range(args.runs):
+        total, modules = measure()
+        timings.append(total)
+    median = statistics.median(timings)
+    print(f"import main: median {median:.1f} ms, min {min(timings):.1f} ms")
+
+    failed = False
+    eager = _lazy(modules)
+    if eager:
+        print(f"FAIL: lazily loaded modules imported eagerly: {eager[:10]}")
+        failed = True
+    eager = _lazy(modules_after_sync())
+    if eager:
+        print(f"FAIL: lazily loaded modules imported by sync_chart_data: {eager[:10]}")
+        failed = True
+    if median > args.budget:
+        print(f"FAIL: import time exceeds budget of {args.budget:.0f} ms")
+        failed = True
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
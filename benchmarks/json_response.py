@@ -0,0 +1,129 @@
+"""
+响应序列化基准：比较 basic_info 与 recommend_chart 两类响应在
+旧路径（pydantic模型 + jsonable_encoder + 标准库json / 带default回调的标准库json）
+与 CustomJSONResponse（orjson）下的序列化耗时。
+
+用法: python benchmarks/json_response.py [--charts 5000] [--repeat 20]
+"""
+import argparse
+import os
+import sys
+import timeit
+from decimal import Decimal
+
+import numpy as np
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from fastapi.encoders import jsonable_encoder  # noqa: E402
+from starlette.responses import JSONResponse  # noqa: E402
+
+import endpoint  # noqa: E402
+from model import GeneralResponseModel  # noqa: E402
+
+
+def basic_info_payload(charts: int) -> dict:
+    rng = np.random.default_rng(0)
+    return {
+        f"{i // 5}-{i % 5 + 1}": {
+            "song_title": f"song title {i // 5}",
+            "artist": f"artist {i // 5 % 300}",
+            "bpm": 150,
+            "version": "maimai でらっくす",
+            "genre": "niconico & VOCALOID",
+            "is_new": False,
+            "type": 1,
+            "chart_design": "charter",
+            "tap_note": 300,
+            "hold_note": 40,
+            "slide_note": 30,
+            "touch_note": 20,
+            "break_note": 10,
+            "difficulty": Decimal("13.7"),
+            "old_difficulty": Decimal("13.6"),
+            "sample_num": 1234,
+            "fit_difficulty": Decimal("13.81234"),
+            "avg_achievement": Decimal("98.12345"),
+            "avg_dxscore": Decimal("1234.56789"),
+            "std_dev": Decimal("1.23456"),
+            "achievement_dist": rng.integers(0, 100, 14).tolist(),
+            "fc_dist": rng.integers(0, 100, 5).tolist(),
+            "like": 3,
+            "dislike": 1,
+            "weight": Decimal("1"),
+        }
+        for i in range(charts)
+    }
+
+
+def recommend_payload(limit: int) -> list:
+    rng = np.random.default_rng(1)
+    return [
+        {
+            "song_id": np.int64(rng.integers(1, 2000)),
+            "level": np.int8(4),
+            "difficulty": np.float64(13.7),
+            "fit_difficulty": np.float64(rng.uniform(12, 15)),
+            "avg_achievement": np.float64(rng.uniform(95, 100)),
+            "like": np.int32(3),
+            "dislike": np.int32(1),
+            "expected_rating_gain": np.float64(rng.uniform(0, 10)),
+            "predicted_achievement": np.float64(rng.uniform(95, 101)),
+        }
+        for _ in range(limit)
+    ]
+
+
+def legacy_model_response(data) -> bytes:
+    # FastAPI对非Response返回值的处理：jsonable_encoder后再交给JSONResponse
+    return JSONResponse(jsonable_encoder(GeneralResponseModel(data=data))).body
+
+
+def legacy_custom_response(data) -> bytes:
+    orjson, endpoint.orjson = endpoint.orjson, None
+    try:
+        return endpoint.json_response(data).body
+    finally:
+        endpoint.orjson = orjson
+
+
+def fast_response(data) -> bytes:
+    return endpoint.json_response(data).body
+
+
+def bench(name: str, func, data, repeat: int) -> float:
+    best = min(timeit.repeat(lambda: func(data), number=1, repeat=repeat))
+    print(f"  {name:<32}{best * 1000:9.3f} ms")
+    return best
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--charts", type=int, default=5000)
+    parser.add_argument("--limit", type=int, default=50)
+    parser.add_argument("--repeat", type=int, default=20)
+    args = parser.parse_args()
+    if endpoint.orjson is None:
+        print("orjson is not installed, nothing to compare")
+        return 1
+
+    print(f"basic_info ({args.charts} charts)")
+    data = basic_info_payload(args.charts)
+    before = bench(
+        "GeneralResponseModel + stdlib", legacy_model_response, data, args.repeat
+    )
+    after = bench("CustomJSONResponse (orjson)", fast_response, data, args.repeat)
+    print(f"  speedup {before / after:.1f}x")
+
+    print(f"recommend_chart ({args.limit} charts)")
+    data = recommend_payload(args.limit)
+    before = bench(
+        "CustomJSONResponse (stdlib)", legacy_custom_response, data, args.repeat
+    )
+    after = bench("CustomJSONResponse (orjson)", fast_response, data, args.repeat * 50)
+    print(f"  speedup {before / after:.1f}x")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,212 @@
+from typing import Dict, Optional
+
+import numpy as np
+from peewee import JOIN
+
+from const import *
+from database import ChartInfo, ChartStat, SongInfo
+from log import logger
+
+GRADE_NUM = len(ACHIEVEMENT_GRADE_BOUNDS)
+FC_GRADE_NUM = 5  # 非FC / FC / FC+ / AP / AP+
+
+
+class ChartCatalog:
+    """
+    谱面目录：将 ChartInfo / SongInfo / ChartStat 展开为按谱面位置对齐的数组，
+    供推荐、统计等需要全量扫描谱面的计算直接向量化使用。
+    谱面按 song_id * 10 + level 升序排列。
+    """
+
+    def __init__(
+        self,
+        arrays: Optional[Dict[str, np.ndarray]] = None,
+        source: Optional[str] = None,
+    ):
+        if arrays is None:
+            arrays = self._empty_arrays()
+        self.arrays = arrays
+        self.source = source  # 从快照映射而来时为快照目录
+        for name, value in arrays.items():
+            setattr(self, name, value)
+
+    def __len__(self):
+        return len(self.key)
+
+    @staticmethod
+    def _empty_arrays() -> Dict[str, np.ndarray]:
+        return {
+            "key": np.zeros(0, dtype=np.int64),
+            "song_id": np.zeros(0, dtype=np.int64),
+            "level": np.zeros(0, dtype=np.int8),
+            "difficulty": np.zeros(0, dtype=np.float64),
+            "old_difficulty": np.zeros(0, dtype=np.float64),
+            "is_new": np.zeros(0, dtype=bool),
+            "chart_type": np.zeros(0, dtype=np.int8),
+            "genre": np.zeros(0, dtype=np.int16),
+            "version": np.zeros(0, dtype=np.int16),
+            "notes": np.zeros((0, 5), dtype=np.int32),
+            "has_stat": np.zeros(0, dtype=bool),
+            "sample_num": np.zeros(0, dtype=np.int32),
+            "fit_difficulty": np.zeros(0, dtype=np.float64),
+            "avg_achievement": np.zeros(0, dtype=np.float64),
+            "std_dev": np.zeros(0, dtype=np.float64),
+            "like": np.zeros(0, dtype=np.int32),
+            "dislike": np.zeros(0, dtype=np.int32),
+            "weight": np.zeros(0, dtype=np.float64),
+            "achievement_dist": np.zeros((0, GRADE_NUM), dtype=np.float64),
+            "fc_dist": np.zeros((0, FC_GRADE_NUM), dtype=np.float64),
+            # 各评级区间下界处的累计人数占比，最后一列恒为1（无统计数据时全为0）
+            "achievement_cdf": np.zeros((0, GRADE_NUM + 1), dtype=np.float64),
+        }
+
+    @classmethod
+    def from_database(cls) -> "ChartCatalog":
+        query = (
+            ChartInfo.select(
+                ChartInfo.song_id,
+                ChartInfo.level,
+                ChartInfo.difficulty,
+                ChartInfo.old_difficulty,
+                ChartInfo.tap_note,
+                ChartInfo.hold_note,
+                ChartInfo.slide_note,
+                ChartInfo.touch_note,
+                ChartInfo.break_note,
+                SongInfo.is_new,
+                SongInfo.type,
+                SongInfo.genre,
+                SongInfo.version,
+                ChartStat.sample_num,
+                ChartStat.fit_difficulty,
+                ChartStat.avg_achievement,
+                ChartStat.std_dev,
+                ChartStat.like,
+                ChartStat.dislike,
+                ChartStat.weight,
+                ChartStat.achievement_dist,
+                ChartStat.fc_dist,
+            )
+            .join(SongInfo, on=(ChartInfo.song_id == SongInfo.song_id))
+            .switch(ChartInfo)
+            .join(
+                ChartStat,
+                on=(ChartInfo.song_id == ChartStat.song_id)
+                & (ChartInfo.level == ChartStat.level),
+                join_type=JOIN.LEFT_OUTER,
+            )
+            .order_by(ChartInfo.song_id, ChartInfo.level)
+            .tuples()
+        )
+        rows = list(query)
+        n = len(rows)
+        arrays = cls._empty_arrays()
+        for name, value in arrays.items():
+            arrays[name] = np.zeros((n,) + value.shape[1:], dtype=value.dtype)
+
+        genre_index = {genre: index for index, genre in enumerate(SONG_GENRE)}
+        version_index = {version: index for index, version in enumerate(MAIMAI_VERSION)}
+        for i, row in enumerate(rows):
+            (
+                song_id,
+                level,
+                difficulty,
+                old_difficulty,
+                tap,
+                hold,
+                slide,
+                touch,
+                break_,
+                is_new,
+                chart_type,
+                genre,
+                version,
+                sample_num,
+                fit_difficulty,
+                avg_achievement,
+                std_dev,
+                like,
+                dislike,
+                weight,
+                achievement_dist,
+                fc_dist,
+            ) = row
+            arrays["song_id"][i] = song_id
+            arrays["level"][i] = level
+            arrays["difficulty"][i] = float(difficulty)
+            arrays["old_difficulty"][i] = float(old_difficulty)
+            arrays["notes"][i] = (tap, hold, slide, touch, break_)
+            arrays["is_new"][i] = bool(is_new)
+            arrays["chart_type"][i] = chart_type
+            arrays["genre"][i] = genre_index.get(genre, -1)
+            arrays["version"][i] = version_index.get(version, -1)
+            if sample_num is None:
+                arrays["fit_difficulty"][i] = float(difficulty)
+                continue
+            arrays["has_stat"][i] = True
+            arrays["sample_num"][i] = sample_num
+            arrays["fit_difficulty"][i] = float(fit_difficulty)
+            arrays["avg_achievement"][i] = float(avg_achievement)
+            arrays["std_dev"][i] = float(std_dev)
+            arrays["like"][i] = like
+            arrays["dislike"][i] = dislike
+            arrays["weight"][i] = float(weight)
+            arrays["achievement_dist"][i] = _fixed_length(achievement_dist, GRADE_NUM)
+            arrays["fc_dist"][i] = _fixed_length(fc_dist, FC_GRADE_NUM)
+
+        arrays["key"] = arrays["song_id"] * 10 + arrays["level"]
+        arrays["achievement_cdf"] = _cumulative_share(arrays["achievement_dist"])
+        return cls(arrays)
+
+    def indices_of(self, song_ids, levels) -> np.ndarray:
+        """批量查询谱面位置，不存在的谱面返回-1"""
+        keys = np.asarray(song_ids, dtype=np.int64) * 10 + np.asarray(levels)
+        if len(self) == 0:
+            return np.full(keys.shape, -1, dtype=np.int64)
+        positions = np.minimum(np.searchsorted(self.key, keys), len(self) - 1)
+        return np.where(self.key[positions] == keys, positions, -1)
+
+    def index_of(self, song_id: int, level: int) -> int:
+        return int(self.indices_of([song_id], [level])[0])
+
+    def set_votes(self, like: np.ndarray, dislike: np.ndarray) -> None:
+        """以新数组整体替换点赞/点踩数"""
+        self.like = self.arrays["like"] = like
+        self.dislike = self.arrays["dislike"] = dislike
+
+
+def _cumulative_share(dist: np.ndarray) -> np.ndarray:
+    cumulative = np.zeros((dist.shape[0], dist.shape[1] + 1), dtype=np.float64)
+    np.cumsum(dist, axis=1, out=cumulative[:, 1:])
+    total = cumulative[:, -1:]
+    return np.divide(cumulative, total, out=np.zeros_like(cumulative), where=total > 0)
+
+
+def _fixed_length(values, length: int) -> np.ndarray:
+    result = np.zeros(length, dtype=np.float64)
+    if values:
+        values = values[:length]
+        result[: len(values)] = values
+    return result
+
+
+_catalog = ChartCatalog()
+
+
+def get_catalog() -> ChartCatalog:
+    return _catalog
+
+
+def set_catalog(catalog: ChartCatalog) -> None:
+    global _catalog
+    _catalog = catalog
+
+
+def refresh_catalog() -> ChartCatalog:
+    global _catalog
+    try:
+        _catalog = ChartCatalog.from_database()
+    except Exception as e:
+        logger.exception(e)
+        logger.critical(f"Error <{e}> encountered while building chart catalog")
+    return _catalog
@@ -0,0 +1,104 @@
+import asyncio
+from concurrent.futures import ProcessPoolExecutor
+from typing import Callable, Optional
+
+from catalog import ChartCatalog, get_catalog
+from exception import ComputeBusyError
+from log import logger
+from tracing import span
+
+_worker_catalog: Optional[ChartCatalog] = None  # 计算进程中的谱面目录
+
+
+def _initialize_worker(arrays: Optional[dict], source: Optional[str]) -> None:
+    global _worker_catalog
+    if source is not None:
+        # 目录来自快照时直接映射同一份文件，不必复制数组
+        from snapshot import load_catalog_snapshot
+
+        _worker_catalog = load_catalog_snapshot(source)
+    else:
+        _worker_catalog = ChartCatalog(arrays)
+
+
+def _run_in_worker(func: Callable, args: tuple):
+    return func(_worker_catalog, *args)
+
+
+class ComputeExecutor:
+    """
+    CPU密集计算的进程池。进程启动时载入当前的谱面目录，目录更新后重建进程池；
+    被调度的函数以谱面目录为第一个参数，其余参数应为numpy数组等紧凑数据。
+    """
+
+    def __init__(self):
+        self._pool: Optional[ProcessPoolExecutor] = None
+        self._catalog: Optional[ChartCatalog] = None
+        self._workers = 0
+        self._max_pending = 0
+        self._timeout = 0.0
+        self._pending = 0
+
+    def start(
+        self, workers: int, max_pending: int, timeout: float, catalog: ChartCatalog
+    ) -> None:
+        self._workers = workers
+        self._max_pending = max_pending
+        self._timeout = timeout
+        if workers > 0:
+            self._restart(catalog)
+
+    def _restart(self, catalog: ChartCatalog) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+        logger.info(f"starting {self._workers} compute workers")
+        self._pool = ProcessPoolExecutor(
+            max_workers=self._workers,
+            initializer=_initialize_worker,
+            initargs=(
+                None if catalog.source else catalog.arrays,
+                catalog.source,
+            ),
+        )
+        self._catalog = catalog
+
+    def shutdown(self) -> None:
+        if self._pool is not None:
+            self._pool.shutdown(wait=False)
+            self._pool = None
+
+    async def run(self, func: Callable, *args, catalog: Optional[ChartCatalog] = None):
+        with span(f"compute:{func.__name__}"):
+            return await self._run(func, args, catalog)
+
+    async def _run(self, func: Callable, args: tuple, catalog: Optional[ChartCatalog]):
+        if catalog is None:
+            catalog = get_catalog()
+        if (
+            self._pool is not None
+            and catalog is not self._catalog
+            and catalog is get_catalog()
+        ):
+            self._restart(catalog)
+        if self._pool is None or catalog is not self._catalog:
+            # 未启用进程池，或调用方持有的是已被替换的旧目录
+            return func(catalog, *args)
+        if self._pending >= self._max_pending:
+            raise ComputeBusyError
+        self._pending += 1
+        loop = asyncio.get_running_loop()
+        future = self._pool.submit(_run_in_worker, func, args)
+        # 超时后任务仍在计算进程中运行，直到任务真正结束才释放名额
+        future.add_done_callback(
+            lambda _: loop.call_soon_threadsafe(self._release_pending)
+        )
+        try:
+            return await asyncio.wait_for(asyncio.wrap_future(future), self._timeout)
+        except asyncio.TimeoutError:
+            raise ComputeBusyError("计算超时，请稍后重试")
+
+    def _release_pending(self) -> None:
+        self._pending -= 1
+
+
+compute_executor = ComputeExecutor()
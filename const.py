@@ -16,6 +16,9 @@ SONG_RATING_COEFFICIENT = [
     [100.4999, 22.2, "sss"],
     [100.5, 22.4, "sssp"],
 ]
+# 查分器统计中 dist 各区间的下界，依次为 d c b bb bbb a aa aaa s sp ss ssp sss sssp
+ACHIEVEMENT_GRADE_BOUNDS = [0, 50, 60, 70, 75, 80, 90, 94, 97, 98, 99, 99.5, 100, 100.5]
+FC_STATUS = ["", "fc", "fcp", "ap", "app"]  # 与查分器 fc_dist 的顺序一致
 VERSION_FILE = "https://bucket-1256206908.cos.ap-shanghai.myqcloud.com/update.json"
 STAT_API = "https://www.diving-fish.com/api/maimaidxprober/chart_stats"
 PLAYER_DATA_DEV_API = (
@@ -28,6 +31,14 @@ STD_CHART = 1
 
 LIKE = 0
 DISLIKE = 1
+RETRACT_VOTE = 2  # 撤销投票
+
+# 各推荐偏好下的目标达成率
+RECOMMEND_MINIUM_ACHIEVEMENT = {
+    "aggressive": 97.0000,
+    "balance": 99.0000,
+    "conservative": 100.0000,
+}
 
 MAIMAI_VERSION = [
     "maimai",
@@ -1,31 +1,60 @@
 import asyncio
-import traceback
-import uuid
+import time
 from functools import wraps
 from typing import Tuple
+from urllib.parse import urlencode
 
-import httpx
 import numpy as np
-import scipy.stats as stats
 from cachetools import TTLCache
-from peewee import JOIN, fn
+from pydantic import BaseModel
 
+from aggregation import chart_stat_aggregator
+from catalog import ChartCatalog, get_catalog, refresh_catalog
+from compute import compute_executor
 from database import *
 from exception import ParameterError
 from log import logger
+from metrics import cache_evictions, cache_requests, upstream_request_duration
 from model import *
+from overlay import PlayerOverlay, player_overlay_cache
+from player_profile import PlayerProfile
+from rating import chart_percentile, rank_by_expected_gain
+from rerating import count_changed_charts, run_rating_rebuild
+from search import refresh_search_index, search_songs
+from shared_cache import shared_cache
+from similarity import get_similarity_index
+from skill import predict_player_achievement
+from snapshot import publish_catalog, reload_catalog_snapshot
+from sync_jobs import SyncJob, sync_job_queue
+from tracing import set_span_attribute, span, traced
+from voting import vote_rollup
 
 general_stat = {}
-new_song_id = []
+new_song_id = set()
 best_fit = None  # 拟合模型参数
+_indexed_song_ids = None  # 当前搜索索引对应的谱面目录中的歌曲
+SIMILARITY_SEED_NUM = 10  # 相似推荐时作为种子的谱面数
+SIMILARITY_NEIGHBOUR_NUM = 20  # 每张种子谱面取的相似谱面数
 
 
 class BestFitDistribution:
     def __init__(self, data):
         self.data = data
-        self.distribution, self.params = self._select_best_fit(data)
+        self._distribution, self.params = self._select_best_fit(data)
+        self.name = self._distribution.name
+
+    @property
+    def distribution(self):
+        # 由参数还原时不载入scipy.stats，首次计算百分位时才取得分布
+        if self._distribution is None:
+            import scipy.stats as stats
+
+            self._distribution = getattr(stats, self.name)
+        return self._distribution
 
     def _fit_distributions(self, data):
+        import scipy.stats as stats  # scipy.stats导入耗时较长，仅在用到时载入
+
         lognorm_params = stats.lognorm.fit(data, floc=0)
         gamma_params = stats.gamma.fit(data, floc=0)
         weibull_params = stats.weibull_min.fit(data, floc=0)
@@ -33,6 +62,8 @@ class BestFitDistribution:
 
     def _select_best_fit(self, data):
         distribution_params = self._fit_distributions(data)
+        import scipy.stats as stats
+
         aics = []
         distributions = [stats.lognorm, stats.gamma, stats.weibull_min]
 
@@ -47,16 +78,41 @@ class BestFitDistribution:
         best_fit_distribution = distributions[best_fit_idx]
         return best_fit_distribution, best_fit_params
 
+    def to_params(self) -> dict:
+        return {"distribution": self.name, "params": list(self.params)}
+
+    @classmethod
+    def from_params(cls, params: dict) -> "BestFitDistribution":
+        # 由已发布的参数还原，不重新拟合
+        instance = cls.__new__(cls)
+        instance.data = None
+        instance._distribution = None
+        instance.name = params["distribution"]
+        instance.params = tuple(params["params"])
+        return instance
+
     def percentile(self, new_data):
         percentile = self.distribution.cdf(new_data, *self.params) * 100
         return percentile
 
 
 class AsyncTTLCache(TTLCache):
-    def __init__(self, *args, **kwargs):
+    def __init__(self, *args, name: str = "", **kwargs):
         super().__init__(*args, **kwargs)
+        self.name = name  # 指标中的缓存名
         self._lock = asyncio.Lock()
 
+    def popitem(self):
+        # 容量已满时由TTLCache调用以淘汰条目。
+        # TTLCache.popitem内部调用self.pop，而这里的pop是协程，不能沿用父类实现
+        self.expire()
+        try:
+            key = next(iter(self))
+        except StopIteration:
+            raise KeyError(f"{type(self).__name__} is empty") from None
+        cache_evictions.inc(self.name)
+        return key, TTLCache.pop(self, key)
+
     async def get(self, key):
         async with self._lock:
             return super().get(key)
@@ -70,44 +126,98 @@ class AsyncTTLCache(TTLCache):
             super().__setitem__(key, value)
 
 
+def _cache_key_default(obj):
+    # 玩家成绩等对象使用其自带的cache_key，pydantic模型使用其字段
+    if hasattr(obj, "cache_key"):
+        return obj.cache_key
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not cacheable")
+
+
 def async_ttl_cache(cache):
+    # 进程内缓存未命中时再查询各worker共享的缓存（如已启用）
     def decorator(func):
+        namespace = f"{func.__module__}.{func.__qualname__}"
+        span_name = f"cache:{cache.name}"
+
         @wraps(func)
         async def wrapped(*args, **kwargs):
-            serialized_args = json.dumps(args, sort_keys=True)
-            serialized_kwargs = json.dumps(kwargs, sort_keys=True)
-            key = (serialized_args, serialized_kwargs)
-            if await cache.get(key) is None:
-                value = await func(*args, **kwargs)
-                await cache.set(key, value)
-            else:
+            with span(span_name, func=func.__qualname__):
+                serialized_args = json.dumps(
+                    args, sort_keys=True, default=_cache_key_default
+                )
+                serialized_kwargs = json.dumps(
+                    kwargs, sort_keys=True, default=_cache_key_default
+                )
+                key = (namespace, serialized_args, serialized_kwargs)
                 value = await cache.get(key)
-            return value
+                if value is not None:
+                    cache_requests.inc(cache.name, "hit")
+                    set_span_attribute("result", "hit")
+                    return value
+                computed = False
+
+                async def compute():
+                    nonlocal computed
+                    computed = True
+                    return await func(*args, **kwargs)
+
+                if shared_cache is None:
+                    value = await compute()
+                else:
+                    value = await shared_cache.get_or_compute(
+                        shared_cache.make_key(
+                            namespace, serialized_args + serialized_kwargs
+                        ),
+                        cache.ttl,
+                        compute,
+                    )
+                result = "miss" if computed else "shared_hit"
+                cache_requests.inc(cache.name, result)
+                set_span_attribute("result", result)
+                await cache.set(key, value)
+                return value
 
         return wrapped
 
     return decorator
 
 
-basic_info_cache = AsyncTTLCache(maxsize=100, ttl=43200)  # 歌曲及谱面基本信息缓存12小时
-stat_cache = AsyncTTLCache(maxsize=150, ttl=1800)  # 统计信息缓存30分钟
-player_record_cache = AsyncTTLCache(maxsize=250, ttl=300)  # 缓存5分钟
+basic_info_cache = AsyncTTLCache(
+    maxsize=100, ttl=43200, name="basic_info_cache"
+)  # 歌曲及谱面基本信息缓存12小时
+stat_cache = AsyncTTLCache(maxsize=150, ttl=1800, name="stat_cache")  # 统计信息缓存30分钟
+player_record_cache = AsyncTTLCache(
+    maxsize=250, ttl=300, name="player_record_cache"
+)  # 缓存5分钟
 
 
-async def get_song_version() -> Tuple[str, str]:
+async def fetch_upstream(target: str, url: str):
+    # 请求上游接口并记录耗时，target为指标中的接口名
+    import httpx  # httpx仅在拉取上游数据时使用，延迟载入
+
+    start = time.perf_counter()
+    outcome = "error"
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = (await client.get(VERSION_FILE)).json()
-    except Exception as e:
-        raise
+        with span(f"upstream:{target}"):
+            async with httpx.AsyncClient(timeout=10) as client:
+                resp = (await client.get(url)).json()
+        outcome = "ok"
+        return resp
+    finally:
+        upstream_request_duration.observe(time.perf_counter() - start, target, outcome)
+
+
+async def get_song_version() -> Tuple[str, str]:
+    resp = await fetch_upstream("song_version", VERSION_FILE)
     return resp["data_version"], resp["data_url"]
 
 
 async def check_song_update() -> None:
     logger.info("checking update for song database")
     try:
-        remote_version = (await get_song_version())[0]
-        remote_data_url = (await get_song_version())[1]
+        remote_version, remote_data_url = await get_song_version()
         try:
             local_version = SongDataVersion.get_or_none(key="version").value
         except Exception as e:
@@ -123,14 +233,59 @@ async def check_song_update() -> None:
         await run_song_update(remote_data_url, remote_version)
 
 
+def _published_state() -> dict:
+    # 随谱面目录快照发布给其他worker的数据
+    return {
+        "general_stat": general_stat,
+        "best_fit": best_fit.to_params() if best_fit is not None else None,
+    }
+
+
+def _sync_search_index(force: bool = False) -> None:
+    # 谱面目录中的歌曲有增减（或本进程尚未建立索引）时重建搜索索引
+    global _indexed_song_ids
+    song_ids = set(get_catalog().song_id.tolist())
+    if force or song_ids != _indexed_song_ids:
+        refresh_search_index()
+        _indexed_song_ids = song_ids
+
+
+def _apply_published_state(state: dict) -> None:
+    global general_stat, new_song_id, best_fit
+    catalog = get_catalog()
+    new_song_id = set(catalog.song_id[catalog.is_new].tolist())
+    _sync_search_index()
+    if state.get("general_stat"):
+        general_stat = state["general_stat"]
+    if state.get("best_fit"):
+        best_fit = BestFitDistribution.from_params(state["best_fit"])
+
+
+def refresh_chart_data() -> ChartCatalog:
+    # 重建谱面目录并发布快照；相似度索引在首次查询时重建
+    vote_rollup.flush()
+    return publish_catalog(refresh_catalog(), _published_state())
+
+
+def sync_chart_data() -> bool:
+    # 切换到leader发布的新快照，返回是否有更新
+    state = reload_catalog_snapshot()
+    if state is None:
+        return False
+    _apply_published_state(state)
+    return True
+
+
 def update_new_song_id():
     global new_song_id
-    new_song_id = [
+    new_song_id = {
         i["song_id"]
         for i in list(
             SongInfo.select(SongInfo.song_id).where(SongInfo.is_new == True).dicts()
         )
-    ]
+    }
+    refresh_chart_data()
+    _sync_search_index(force=True)
 
 
 async def run_song_update(data_url: str, new_version: str) -> None:
@@ -138,15 +293,14 @@ async def run_song_update(data_url: str, new_version: str) -> None:
     songs_data = []
     charts_data = []
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = (await client.get(data_url)).json()
+        resp = await fetch_upstream("song_data", data_url)
     except Exception as e:
         logger.exception(e)
         logger.critical(
             f"Error <{e}> encountered while checking update for song database"
         )
         return
-    new_song_id = []
+    new_song_id = set()
     for song in resp:
         song_info_dict = {
             "song_id": int(song["id"]),
@@ -159,7 +313,7 @@ async def run_song_update(data_url: str, new_version: str) -> None:
             "type": DX_CHART if song["type"] == "DX" else STD_CHART,
         }
         if song["basic_info"]["is_new"]:
-            new_song_id.append(song["id"])
+            new_song_id.add(int(song["id"]))
         songs_data.append(song_info_dict)
         for index, charts in enumerate(song["charts"]):
             charts_info_dict = {
@@ -187,6 +341,12 @@ async def run_song_update(data_url: str, new_version: str) -> None:
     SongInfo.replace_many(songs_data).execute()
     ChartInfo.replace_many(charts_data).execute()
     SongDataVersion.replace(key="version", value=new_version).execute()
+    previous_catalog = get_catalog()
+    changed = count_changed_charts(previous_catalog, refresh_chart_data())
+    _sync_search_index(force=True)  # 别名可能有变化，歌曲集合相同时也重建
+    if changed:
+        # 定数有变化，重算已保存的成绩
+        asyncio.create_task(run_rating_rebuild(new_version))
 
 
 async def run_chart_stat_update() -> None:
@@ -194,8 +354,7 @@ async def run_chart_stat_update() -> None:
     chart_stats = []
     logger.info("updating chart statistics")
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = (await client.get(STAT_API)).json()
+        resp = await fetch_upstream("chart_stat", STAT_API)
     except Exception as e:
         logger.exception(e)
         logger.critical(
@@ -220,55 +379,65 @@ async def run_chart_stat_update() -> None:
                     "fc_dist": chart["fc_dist"],
                 }
             )
-    ChartStat.replace_many(chart_stats).execute()
-
-
-def separate_personal_data(personal_raw_data: dict) -> Tuple[List, List]:
-    personal_raw_data = personal_raw_data["records"]
-    new_charts = filter(lambda x: x["song_id"] in new_song_id, personal_raw_data)
-    old_charts = filter(lambda x: x["song_id"] not in new_song_id, personal_raw_data)
-    return list(old_charts), list(new_charts)
+    # 保留点赞/点踩数与权重，仅更新统计字段
+    ChartStat.insert_many(chart_stats).on_conflict(
+        preserve=[
+            ChartStat.sample_num,
+            ChartStat.fit_difficulty,
+            ChartStat.avg_achievement,
+            ChartStat.avg_dxscore,
+            ChartStat.std_dev,
+            ChartStat.achievement_dist,
+            ChartStat.fc_dist,
+        ]
+    ).execute()
+    refresh_chart_data()
 
 
-async def record_player_data(personal_raw_data: dict) -> None:
+async def record_player_data(profile: PlayerProfile) -> None:
     # 后台任务
     # TODO:去重（指去掉achievement相同的歌）
-    player_id = personal_raw_data["username"]
-    charts_list = []
-    for charts in personal_raw_data["records"]:
-        charts_list.append(
-            {
-                "player_id": player_id,
-                "song_id": charts["song_id"],
-                "level": charts["level_index"] + 1,
-                "type": STD_CHART if charts["type"] == "SD" else DX_CHART,
-                "achievement": charts["achievements"],
-                "rating": charts["ra"],
-                "dxscore": charts["dxScore"],
-                "fc_status": charts["fc"],
-                "fs_status": charts["fs"],
-            }
-        )
-    old_charts, new_charts = separate_personal_data(personal_raw_data)
-    old_charts.sort(key=lambda x: x["ra"], reverse=True)
-    new_charts.sort(key=lambda x: x["ra"], reverse=True)
-    old_rating = 0
-    new_rating = 0
-    for i in old_charts[:35]:
-        old_rating += i["ra"]
-    for i in new_charts[:15]:
-        new_rating += i["ra"]
-    RatingRecord.replace(
+    player_id = profile.username
+    charts_list = [
         {
             "player_id": player_id,
-            "old_song_rating": old_rating,
-            "new_song_rating": new_rating,
+            "song_id": song_id,
+            "level": level,
+            "type": STD_CHART if chart_type == "SD" else DX_CHART,
+            "achievement": achievement,
+            "rating": rating,
+            "dxscore": dxscore,
+            "fc_status": fc,
+            "fs_status": fs,
         }
-    ).execute()
-    ChartRecord.replace_many(charts_list).execute()
+        for (
+            song_id,
+            level,
+            chart_type,
+            achievement,
+            rating,
+            dxscore,
+            fc,
+            fs,
+            _,
+        ) in profile.records.tolist()
+    ]
+    # 同一玩家的成绩可能同时在多个worker上写入，旧的最好成绩须在锁内读取，
+    # 否则两边会以同一份旧成绩计算增量，社区统计被重复累加
+    with named_lock(f"record:{player_id}"), song_database.atomic():
+        previous_best = chart_stat_aggregator.player_best_records(player_id)
+        RatingRecord.replace(
+            {
+                "player_id": player_id,
+                "old_song_rating": profile.old_rating,
+                "new_song_rating": profile.new_rating,
+            }
+        ).execute()
+        ChartRecord.replace_many(charts_list).execute()
+        chart_stat_aggregator.apply(previous_best, profile.records)
 
 
-@async_ttl_cache(player_record_cache)
+@traced("upstream:player_data")
 async def get_player_data_from_remote(
     player_id: Optional[str] = None, bind_qq: Optional[int] = None
 ) -> dict:
@@ -295,35 +464,67 @@ async def get_player_data_from_remote(
 
 
 @async_ttl_cache(player_record_cache)
+async def get_player_profile(
+    player_id: Optional[str] = None, bind_qq: Optional[int] = None
+) -> PlayerProfile:
+    # 查分器数据只在这里解析一次，之后各处共用
+    data = await get_player_data_from_remote(player_id, bind_qq)
+    with span("parse:player_profile"):
+        return PlayerProfile.from_response(data, new_song_id)
+
+
+async def sync_player_record(job: SyncJob) -> str:
+    # 由同步任务队列执行，返回成绩的查询地址
+    sync_job_queue.report(job, "fetching")
+    profile = await get_player_profile(player_id=job.player_id, bind_qq=job.bind_qq)
+    sync_job_queue.report(job, "saving")
+    await record_player_data(profile)
+    return f"/api/v1/maimai/player/record?{urlencode({'player_id': profile.username})}"
+
+
 async def recommend_charts(
-    personal_raw_data: dict,
+    profile: PlayerProfile,
     preferences: PlayerPreferencesModel = None,
     limit: int = 50,
+) -> dict:
+    # 拉黑与投票的内容是缓存键的一部分，修改后不会再返回缓存中的旧结果
+    await player_overlay_cache.refresh(profile.username)
+    overlay = player_overlay_cache.get(profile.username)
+    return await _recommend_charts(profile, overlay, preferences, limit)
+
+
+@async_ttl_cache(player_record_cache)
+async def _recommend_charts(
+    profile: PlayerProfile,
+    overlay: PlayerOverlay,
+    preferences: Optional[PlayerPreferencesModel],
+    limit: int,
 ) -> dict:
     messages_list = []
     if preferences is None:
         preferences = PlayerPreferencesModel.parse_obj(dict())
-    player_id = personal_raw_data["username"]
-    personal_raw_data = personal_raw_data["records"]
-    personal_raw_data.sort(key=lambda x: x["ra"], reverse=True)
+    new_charts = profile.new_records
+    old_charts = profile.old_records
 
-    new_charts = list(filter(lambda x: x["song_id"] in new_song_id, personal_raw_data))
-    old_charts = list(
-        filter(lambda x: x["song_id"] not in new_song_id, personal_raw_data)
-    )
+    charts_score_new = new_charts["rating"][:15].tolist()
+    charts_score_old = old_charts["rating"][:35].tolist()
 
-    charts_score_new = [int(x["ra"]) for x in new_charts[:15]]
-    charts_score_old = [int(x["ra"]) for x in old_charts[:35]]
-    filtered_song_ids = []
-    personal_grades_dict = {}
+    catalog = get_catalog()
+    with span("skill:predict_achievement"):
+        predicted_achievement = await predict_player_achievement(profile, catalog)
 
-    for score in personal_raw_data:
-        personal_grades_dict[(score["song_id"], score["level_index"])] = score
-        if score["achievements"] >= 100.5000:
-            filtered_song_ids.append(score["song_id"])
-            continue
-        if preferences.exclude_played and score["achievements"] >= 94:
-            filtered_song_ids.append(score["song_id"])
+    def _predict_achievement(song_id: int, level: int) -> Optional[float]:
+        # 根据玩家实力模型预测的达成率，已游玩或无法预测时为None
+        position = catalog.index_of(song_id, level)
+        if position < 0 or np.isnan(predicted_achievement[position]):
+            return None
+        return round(float(predicted_achievement[position]), 4)
+
+    achievements = profile.records["achievement"]
+    filtered = achievements >= 100.5000
+    if preferences.exclude_played:
+        filtered |= achievements >= 94
+    filtered_song_ids = np.unique(profile.records["song_id"][filtered])
 
     async def _query_charts(
         is_new: bool, charts_score: list, filtered_song_ids: list
@@ -365,82 +566,110 @@ async def recommend_charts(
         upper_difficulty = float(upper_difficulty)
         lower_difficulty = float(lower_difficulty)
 
-        base_condition = ChartInfo.difficulty.between(
-            lower_difficulty, upper_difficulty
+        candidate_index = np.flatnonzero(
+            _candidate_mask(is_new, filtered_song_ids)
+            & (catalog.difficulty >= lower_difficulty)
+            & (catalog.difficulty <= upper_difficulty)
         )
 
-        grade_condition = (
-            (SongInfo.is_new == True) if is_new else (SongInfo.is_new == False)
-        )
+        # 点赞与点踩之和小于5时比例记为 0.5，否则计算比例
+        like = catalog.like[candidate_index]
+        vote_num = like + catalog.dislike[candidate_index]
+        like_dislike_ratio = np.where(vote_num < 5, 0.5, like / np.maximum(vote_num, 1))
 
-        # 使用 IF 函数，当 like 和 dislike 之和小于5时设为 0.5，否则计算比例
-        like_dislike_ratio = fn.IF(
-            (ChartStat.like + ChartStat.dislike) < 5,
-            0.5,
-            ChartStat.like / (ChartStat.like + ChartStat.dislike),
-        )
+        # 排序计算公式
+        order_value = (
+            catalog.difficulty[candidate_index]
+            - catalog.fit_difficulty[candidate_index]
+            + like_dislike_ratio
+        ) * catalog.weight[candidate_index]
+        order = np.argsort(-order_value, kind="stable")[:limit]
 
-        # 构建排序计算公式
-        order_expression = (
-            ChartInfo.difficulty - ChartStat.fit_difficulty + like_dislike_ratio
-        ) * ChartStat.weight
+        result_list = _catalog_results(candidate_index[order])
+        return result_list, min_score, minium_achievement
 
-        query = (
-            ChartInfo.select(
-                ChartInfo.song_id,
-                ChartInfo.level,
-                ChartVoting.vote,
-            )
-            .join(
-                ChartStat,
-                on=(ChartInfo.song_id == ChartStat.song_id)
-                & (ChartInfo.level == ChartStat.level),
-            )
-            .join(SongInfo, on=(ChartInfo.song_id == SongInfo.song_id))
-            .join(
-                ChartBlacklist,
-                on=(
-                    (ChartInfo.song_id == ChartBlacklist.song_id)
-                    & (ChartInfo.level == ChartBlacklist.level)
-                    & (ChartBlacklist.player_id == player_id)
-                ),
-                join_type=JOIN.LEFT_OUTER,
-            )
-            .join(
-                ChartVoting,
-                on=(
-                    (ChartInfo.song_id == ChartVoting.song_id)
-                    & (ChartInfo.level == ChartVoting.level)
-                    & (ChartVoting.player_id == player_id)
-                ),
-                join_type=JOIN.LEFT_OUTER,
-            )  # 添加LEFT OUTER JOIN连接chart_voting表
-            .where(
-                (base_condition & grade_condition)
-                & (ChartBlacklist.player_id.is_null())
-                & (~(ChartInfo.song_id << filtered_song_ids))
-            )
-            .where(ChartStat.sample_num >= 100)
-            .order_by(order_expression.desc())
-            .limit(limit)
+    def _candidate_mask(is_new: bool, filtered_song_ids: list) -> np.ndarray:
+        # 谱面目录中可推荐的谱面：对应新旧曲、样本足够、未被过滤或拉黑
+        return (
+            (catalog.is_new == is_new)
+            & (catalog.sample_num >= 100)
+            & ~np.isin(catalog.song_id, filtered_song_ids)
+            & ~overlay.blacklist_mask(catalog)
         )
 
-        # 查询结果转换为包含字典的列表
+    def _catalog_results(positions: np.ndarray, **extra: np.ndarray) -> List[dict]:
         result_list = []
-        for record in query.objects():
-            merged_dict = RecommendChartsResultModel.parse_obj(record.__dict__).dict()
-            if not (
-                _grade := personal_grades_dict.get(
-                    (merged_dict["song_id"], merged_dict["level"] - 1), None
-                )
-            ):
-                merged_dict["achievement"] = 0
-            else:
-                merged_dict["achievement"] = _grade["achievements"]
+        for i, position in enumerate(positions):
+            song_id = int(catalog.song_id[position])
+            level = int(catalog.level[position])
+            _grade = profile.record_of(song_id, level)
+            result = {
+                "song_id": song_id,
+                "level": level,
+                "vote": overlay.vote_of(song_id, level),
+                "achievement": 0 if _grade is None else float(_grade["achievement"]),
+                "predicted_achievement": _predict_achievement(song_id, level),
+            }
+            for name, values in extra.items():
+                result[name] = round(float(values[i]), 4)
+            result_list.append(result)
+        return result_list
 
-            result_list.append(merged_dict)
+    async def _rank_charts_by_rating_gain(
+        is_new: bool, charts_score: list, filtered_song_ids: list
+    ) -> Tuple[List[dict], int, int]:
+        # 按“达到各评级可提升的rating × 该谱面的评级分布”的期望值排序
+        minium_achievement = RECOMMEND_MINIUM_ACHIEVEMENT[
+            preferences.recommend_preferences
+        ]
+        records = new_charts if is_new else old_charts
+        positions, expected_gain = await compute_executor.run(
+            rank_by_expected_gain,
+            np.flatnonzero(_candidate_mask(is_new, filtered_song_ids)),
+            records["song_id"],
+            records["level"],
+            records["rating"],
+            15 if is_new else 35,
+            minium_achievement,
+            limit,
+            catalog=catalog,
+        )
 
-        return result_list, min_score, minium_achievement
+        result_list = _catalog_results(positions, expected_rating_gain=expected_gain)
+        return result_list, np.min(charts_score), minium_achievement
+
+    async def _rank_charts_by_similarity(
+        is_new: bool, charts_score: list, filtered_song_ids: list
+    ) -> Tuple[List[dict], int, int]:
+        # 以玩家rating最高的若干谱面为种子，按与种子谱面的相似程度排序
+        minium_achievement = RECOMMEND_MINIUM_ACHIEVEMENT[
+            preferences.recommend_preferences
+        ]
+        records = (new_charts if is_new else old_charts)[:SIMILARITY_SEED_NUM]
+        seeds = catalog.indices_of(records["song_id"], records["level"])
+        distances, neighbours = get_similarity_index().query(
+            seeds[seeds >= 0], SIMILARITY_NEIGHBOUR_NUM
+        )
+        found = neighbours >= 0
+        score = np.zeros(len(catalog))
+        np.add.at(score, neighbours[found], 1 / (1 + distances[found]))
+
+        candidate = _candidate_mask(is_new, filtered_song_ids)
+        cleared = profile.records[achievements >= minium_achievement]
+        cleared = catalog.indices_of(cleared["song_id"], cleared["level"])
+        candidate[cleared[cleared >= 0]] = False
+        candidate_index = np.flatnonzero(candidate & (score > 0))
+        order = np.argsort(-score[candidate_index], kind="stable")[:limit]
+
+        result_list = _catalog_results(
+            candidate_index[order], similarity=score[candidate_index[order]]
+        )
+        return result_list, np.min(charts_score), minium_achievement
+
+    if preferences.recommend_mode == "rating_gain":
+        _query_charts = _rank_charts_by_rating_gain
+    elif preferences.recommend_mode == "similar":
+        _query_charts = _rank_charts_by_similarity
 
     if len(charts_score_old) < 35:
         messages_list.append(
@@ -453,32 +682,33 @@ async def recommend_charts(
             "messages": messages_list,
         }
     else:
-        (
-            old_songs_recommend,
-            old_song_min_score,
-            minium_achievement,
-        ) = await _query_charts(
-            is_new=False,
-            charts_score=charts_score_old,
-            filtered_song_ids=filtered_song_ids,
-        )
-    count_query = SongInfo.select().where(SongInfo.is_new == True).count()
-    if count_query < 30:
+        with span("query:old_charts", mode=preferences.recommend_mode):
+            (
+                old_songs_recommend,
+                old_song_min_score,
+                minium_achievement,
+            ) = await _query_charts(
+                is_new=False,
+                charts_score=charts_score_old,
+                filtered_song_ids=filtered_song_ids,
+            )
+    if len(new_song_id) < 30:
         new_songs_recommend = []
         new_song_min_score = np.min(charts_score_new)
     elif len(charts_score_new) < 15:
         new_song_min_score = -1
         new_songs_recommend = []
     else:
-        (
-            new_songs_recommend,
-            new_song_min_score,
-            minium_achievement,
-        ) = await _query_charts(
-            is_new=True,
-            charts_score=charts_score_new,
-            filtered_song_ids=filtered_song_ids,
-        )
+        with span("query:new_charts", mode=preferences.recommend_mode):
+            (
+                new_songs_recommend,
+                new_song_min_score,
+                minium_achievement,
+            ) = await _query_charts(
+                is_new=True,
+                charts_score=charts_score_new,
+                filtered_song_ids=filtered_song_ids,
+            )
 
     if len(charts_score_new) < 15:
         messages_list.append(
@@ -511,33 +741,93 @@ async def operate_blacklist(
         ).execute()
     else:
         ChartBlacklist.delete().where(
-            player_id=player_id, song_id=song_id, level=level
+            (ChartBlacklist.player_id == player_id)
+            & (ChartBlacklist.song_id == song_id)
+            & (ChartBlacklist.level == level)
         ).execute()
+    player_overlay_cache.set_blacklisted(player_id, song_id, level, operate == "add")
 
 
 async def get_blacklist(player_id: str) -> list:
-    return list(ChartBlacklist.select().where(player_id == player_id).dicts())
+    return list(
+        ChartBlacklist.select().where(ChartBlacklist.player_id == player_id).dicts()
+    )
 
 
 async def vote_songs(
-    player_id: str, song_id: int, level: int, operate: Literal[LIKE, DISLIKE]
+    player_id: str,
+    song_id: int,
+    level: int,
+    operate: Literal[LIKE, DISLIKE, RETRACT_VOTE],
 ) -> None:
-    ChartVoting.replace(
-        player_id=player_id, song_id=song_id, level=level, vote=operate
-    ).execute()
+    condition = (
+        (ChartVoting.player_id == player_id)
+        & (ChartVoting.song_id == song_id)
+        & (ChartVoting.level == level)
+    )
+    previous = ChartVoting.get_or_none(condition)
+    if operate == RETRACT_VOTE:
+        ChartVoting.delete().where(condition).execute()
+    else:
+        ChartVoting.replace(
+            player_id=player_id, song_id=song_id, level=level, vote=operate
+        ).execute()
+    current = None if operate == RETRACT_VOTE else operate
+    vote_rollup.record(song_id, level, previous.vote if previous else None, current)
+    player_overlay_cache.set_vote(player_id, song_id, level, current)
+
+
+async def rebuild_chart_votes() -> None:
+    # 全量重算耗时较长，放到线程池中执行，不阻塞事件循环
+    await asyncio.get_running_loop().run_in_executor(None, vote_rollup.rebuild)
 
 
 async def get_all_level_stat():
     return general_stat
 
 
+async def get_community_stat(
+    song_id: Optional[int] = None, level: Optional[int] = None
+) -> dict:
+    # 本站统计与查分器统计并列返回
+    catalog = get_catalog()
+    if song_id is not None and level is not None:
+        community = {(song_id, level): chart_stat_aggregator.get(song_id, level)}
+    else:
+        community = {
+            key: value
+            for key, value in chart_stat_aggregator.all().items()
+            if (song_id is None or key[0] == song_id)
+            and (level is None or key[1] == level)
+        }
+    result = {}
+    for (_song_id, _level), stat in community.items():
+        position = catalog.index_of(_song_id, _level)
+        upstream = None
+        if position >= 0 and catalog.has_stat[position]:
+            upstream = {
+                "sample_num": int(catalog.sample_num[position]),
+                "fit_difficulty": float(catalog.fit_difficulty[position]),
+                "avg_achievement": float(catalog.avg_achievement[position]),
+                "std_dev": float(catalog.std_dev[position]),
+                "achievement_dist": catalog.achievement_dist[position].tolist(),
+                "fc_dist": catalog.fc_dist[position].tolist(),
+            }
+        result[f"{_song_id}-{_level}"] = {"community": stat, "upstream": upstream}
+    return result
+
+
+def _chart_keys(query) -> List[dict]:
+    # 只查询song_id与level，直接由元组构造结果，不实例化模型
+    return [{"song_id": song_id, "level": level} for song_id, level in query.tuples()]
+
+
 @async_ttl_cache(stat_cache)
 async def get_difficulty_difference(
     upper_difficulty: Optional[float] = 15.0,
     lower_difficulty: Optional[float] = 11.0,
     limit: int = 20,
 ) -> List[dict]:
-    result = []
     query = (
         ChartInfo.select(ChartInfo.song_id, ChartInfo.level)
         .where(ChartInfo.old_difficulty != -1)
@@ -549,10 +839,7 @@ async def get_difficulty_difference(
         .limit(limit)
     )
 
-    for chart in query.objects():
-        result.append(BasicChartInfoModel.parse_obj(chart.__dict__).dict())
-
-    return result
+    return _chart_keys(query)
 
 
 @async_ttl_cache(stat_cache)
@@ -564,7 +851,6 @@ async def get_most_popular_songs(
     version: Optional[str] = None,
     limit: int = 20,
 ):
-    result = []
     query = (
         ChartInfo.select(ChartInfo.song_id, ChartInfo.level)
         .join(
@@ -593,10 +879,7 @@ async def get_most_popular_songs(
 
     query = query.order_by(ChartStat.sample_num.desc()).limit(limit)
 
-    for chart in query.objects():
-        result.append(BasicChartInfoModel.parse_obj(chart.__dict__).dict())
-
-    return result
+    return _chart_keys(query)
 
 
 @async_ttl_cache(stat_cache)
@@ -605,7 +888,6 @@ async def get_relative_easy_or_hard_songs(
     lower_difficulty: Optional[float] = 11.0,
     limit: int = 20,
 ) -> dict:
-    result = {"easy": [], "hard": []}
     basic_query = (
         ChartInfo.select(ChartInfo.song_id, ChartInfo.level)
         .join(
@@ -629,13 +911,7 @@ async def get_relative_easy_or_hard_songs(
         (ChartStat.fit_difficulty - ChartInfo.difficulty).asc()
     ).limit(limit)
 
-    for chart in desc_query.objects():
-        result["hard"].append(BasicChartInfoModel.parse_obj(chart.__dict__).dict())
-
-    for chart in asc_query.objects():
-        result["easy"].append(BasicChartInfoModel.parse_obj(chart.__dict__).dict())
-
-    return result
+    return {"hard": _chart_keys(desc_query), "easy": _chart_keys(asc_query)}
 
 
 @async_ttl_cache(stat_cache)
@@ -647,7 +923,6 @@ async def get_biggest_deviation_songs(
     version: Optional[str] = None,
     limit: int = 20,
 ):
-    result = []
     query = (
         ChartInfo.select(ChartInfo.song_id, ChartInfo.level)
         .join(
@@ -677,10 +952,28 @@ async def get_biggest_deviation_songs(
 
     query = query.order_by(ChartStat.std_dev.desc()).limit(limit)
 
-    for chart in query.objects():
-        result.append(BasicChartInfoModel.parse_obj(chart.__dict__).dict())
+    return _chart_keys(query)
+
+
+async def get_similar_charts(song_id: int, level: int, k: int = 10) -> List[dict]:
+    index = get_similarity_index()
+    position = index.catalog.index_of(song_id, level)
+    if position < 0:
+        raise ParameterError("谱面不存在")
+    distances, neighbours = index.query(np.array([position]), k)
+    return [
+        {
+            "song_id": int(index.catalog.song_id[neighbour]),
+            "level": int(index.catalog.level[neighbour]),
+            "distance": round(float(distance), 4),
+        }
+        for distance, neighbour in zip(distances[0], neighbours[0])
+        if neighbour >= 0
+    ]
 
-    return result
+
+async def search_charts(q: str, limit: int = 10) -> List[dict]:
+    return search_songs(q, limit)
 
 
 async def get_player_record(player_id: str):
@@ -689,36 +982,59 @@ async def get_player_record(player_id: str):
     chart_result = {}
     rating_result = []
     charts_records = (
-        ChartRecord.select()
+        ChartRecord.select(
+            ChartRecord.song_id,
+            ChartRecord.level,
+            ChartRecord.type,
+            ChartRecord.achievement,
+            ChartRecord.rating,
+            ChartRecord.dxscore,
+            ChartRecord.fc_status,
+            ChartRecord.fs_status,
+            ChartRecord.record_time,
+        )
         .where(ChartRecord.player_id == player_id)
         .order_by(ChartRecord.record_time.desc())
+        .tuples()
     )
-    for r in charts_records:
-        keys = f"{r.song_id}-{r.level}"
-        if keys not in chart_result:
-            chart_result[keys] = []
-        chart_result[keys].append(
+    for (
+        song_id,
+        level,
+        chart_type,
+        achievement,
+        rating,
+        dxscore,
+        fc_status,
+        fs_status,
+        record_time,
+    ) in charts_records:
+        chart_result.setdefault(f"{song_id}-{level}", []).append(
             {
-                "type": r.type,
-                "achievement": float(r.achievement),
-                "rating": r.rating,
-                "dxscore": r.dxscore,
-                "fc_status": r.fc_status,
-                "fs_status": r.fs_status,
-                "record_time": r.record_time.strftime("%Y-%m-%d %H:%M:%S"),
+                "type": chart_type,
+                "achievement": float(achievement),
+                "rating": rating,
+                "dxscore": dxscore,
+                "fc_status": fc_status,
+                "fs_status": fs_status,
+                "record_time": record_time.strftime("%Y-%m-%d %H:%M:%S"),
             }
         )
     rating_records = (
-        RatingRecord.select()
+        RatingRecord.select(
+            RatingRecord.old_song_rating,
+            RatingRecord.new_song_rating,
+            RatingRecord.record_time,
+        )
         .where(RatingRecord.player_id == player_id)
         .order_by(RatingRecord.record_time.desc())
+        .tuples()
     )
-    for r in rating_records:
+    for old_song_rating, new_song_rating, record_time in rating_records:
         rating_result.append(
             {
-                "old_song_rating": r.old_song_rating,
-                "new_song_rating": r.new_song_rating,
-                "record_time": r.record_time.strftime("%Y-%m-%d %H:%M:%S"),
+                "old_song_rating": old_song_rating,
+                "new_song_rating": new_song_rating,
+                "record_time": record_time.strftime("%Y-%m-%d %H:%M:%S"),
             }
         )
     if len(rating_result) >= 1:
@@ -776,8 +1092,7 @@ async def update_public_player_rating() -> None:
     global best_fit
     logger.info("updating player ranking")
     try:
-        async with httpx.AsyncClient(timeout=10) as client:
-            resp = (await client.get(PLAYER_RANKING_API)).json()
+        resp = await fetch_upstream("player_ranking", PLAYER_RANKING_API)
     except Exception as e:
         logger.exception(e)
         logger.critical(
@@ -788,6 +1103,20 @@ async def update_public_player_rating() -> None:
     for i in resp:
         data.append(i["ra"])
     best_fit = BestFitDistribution(data)
+    publish_catalog(get_catalog(), _published_state())
+
+
+async def get_player_chart_percentile(profile: PlayerProfile) -> dict:
+    records = profile.records
+    percentile = await compute_executor.run(
+        chart_percentile, records["song_id"], records["level"], records["achievement"]
+    )
+    return {
+        f"{song_id}-{level}": None if np.isnan(p) else round(float(p), 2)
+        for song_id, level, p in zip(
+            records["song_id"].tolist(), records["level"].tolist(), percentile
+        )
+    }
 
 
 async def get_player_percentile(player_rating: int) -> Optional[float]:
@@ -797,28 +1126,17 @@ async def get_player_percentile(player_rating: int) -> Optional[float]:
         return None
 
 
+def get_readiness() -> dict:
+    # 各项派生数据是否已载入（来自快照或首次拉取）
+    return {
+        "catalog": len(get_catalog()) > 0,
+        "general_stat": bool(general_stat),
+        "player_rating_distribution": best_fit is not None,
+    }
+
+
 async def check_update_on_startup() -> None:
-    await asyncio.sleep(25)
     await check_song_update()
+    await run_rating_rebuild()  # 继续上次未完成的重算（如有）
     await run_chart_stat_update()
     await update_public_player_rating()
-
-
-async def record_exception(e: Exception) -> str:
-    trace_id = str(uuid.uuid4())
-    try:
-        exception_type = type(e).__name__
-        exception_traceback = traceback.format_exc()
-        ExceptionRecord.replace(
-            id=trace_id,
-            type=exception_type,
-            brief=repr(e),
-            traceback=exception_traceback,
-            time=int(time.time()),
-        ).execute()
-    except Exception as e:
-        internal_trace_id = str(uuid.uuid4())
-        logger.exception(
-            f"detail information of internal trace id :{internal_trace_id} (recorded internal exception)\n"
-        )
-    return trace_id
@@ -1,13 +1,21 @@
 import datetime
+import hashlib
 import json
 import os
 import re
 import time
+from contextlib import contextmanager
+from typing import List, Optional
 
 import peewee
 from playhouse.shortcuts import ReconnectMixin
 
+from exception import ServiceBusyError
+from log import logger
+from metrics import record_db_query
 from model import ConfigModel
+from query_stats import QueryStats
+from tracing import span
 
 
 def camel_to_snake(name):
@@ -19,7 +27,30 @@ def camel_to_snake(name):
 
 
 class RetryMySQLDatabase(ReconnectMixin, peewee.MySQLDatabase):
-    pass
+    def execute_sql(self, sql, params=None, commit=None):
+        start = time.perf_counter()
+        try:
+            with span("db", sql=sql[:200]):
+                return super().execute_sql(sql, params, commit)
+        finally:
+            elapsed = time.perf_counter() - start
+            record_db_query(elapsed)
+            stats = query_stats.record(sql, elapsed)
+            if elapsed >= query_stats.threshold:
+                plan = None
+                if query_stats.should_explain(stats, sql):
+                    plan = self._explain(sql, params)
+                query_stats.log_slow(stats, sql, params, elapsed, plan)
+
+    def _explain(self, sql, params) -> Optional[List[dict]]:
+        # pymysql的游标默认一次读完结果，此时在同一连接上再执行EXPLAIN不影响原查询
+        try:
+            cursor = super().execute_sql(f"EXPLAIN {sql}", params)
+            columns = [i[0] for i in cursor.description]
+            return [dict(zip(columns, row)) for row in cursor.fetchall()]
+        except Exception as e:
+            logger.warning(f"Error <{e}> encountered while explaining slow query")
+            return None
 
 
 with open(
@@ -27,6 +58,15 @@ with open(
 ) as f:
     config = ConfigModel.parse_obj(json.load(f))
 
+query_stats = QueryStats(
+    config.slow_query.threshold,
+    config.slow_query.file,
+    config.slow_query.max_bytes,
+    config.slow_query.backup_count,
+    config.slow_query.explain,
+    config.slow_query.explain_interval,
+)
+
 
 class CustomJSONField(peewee.TextField):
     def db_value(self, value):
@@ -34,8 +74,8 @@ class CustomJSONField(peewee.TextField):
         return json.dumps(value)
 
     def python_value(self, value):
-        """将JSON字符串转换回Python字典"""
-        return json.loads(value)
+        """将JSON字符串转换回Python字典，外连接未匹配到的行为NULL"""
+        return json.loads(value) if value is not None else None
 
 
 class LongText(peewee.Field):
@@ -52,6 +92,24 @@ song_database = RetryMySQLDatabase(
 )
 
 
+@contextmanager
+def named_lock(name: str, timeout: int = 10):
+    """
+    MySQL的命名锁（GET_LOCK），用于在各worker之间串行执行同一名称下的操作。
+    锁属于当前线程的连接，须在同一线程中释放。
+    """
+    name = f"maibot:{hashlib.md5(name.encode()).hexdigest()}"  # 锁名最长64字符
+    acquired = song_database.execute_sql(
+        "SELECT GET_LOCK(%s, %s)", (name, timeout)
+    ).fetchone()[0]
+    if acquired != 1:
+        raise ServiceBusyError
+    try:
+        yield
+    finally:
+        song_database.execute_sql("SELECT RELEASE_LOCK(%s)", (name,))
+
+
 class BaseDatabase(peewee.Model):
     pass
 
@@ -74,6 +132,15 @@ class SongInfo(BaseDatabase):
         db_table = camel_to_snake("SongInfo")
 
 
+class SongAlias(BaseDatabase):
+    alias = peewee.CharField()  # 别名，如简称、罗马音
+    song_id = peewee.BigIntegerField()
+
+    class Meta:
+        primary_key = peewee.CompositeKey("alias", "song_id")
+        db_table = camel_to_snake("SongAlias")
+
+
 class ChartInfo(BaseDatabase):
     song_id = peewee.ForeignKeyField(SongInfo, on_delete="CASCADE")
     level = peewee.IntegerField()  # 1~5分别代表Basic~Re:Master
@@ -113,6 +180,22 @@ class ChartStat(BaseDatabase):
         db_table = camel_to_snake("ChartStat")
 
 
+class LocalChartStat(BaseDatabase):
+    # 由本站收集的成绩增量计算的谱面统计
+    song_id = peewee.BigIntegerField()
+    level = peewee.IntegerField()
+
+    sample_num = peewee.IntegerField()
+    mean = peewee.DoubleField()  # 达成率均值
+    m2 = peewee.DoubleField()  # 达成率离差平方和
+    achievement_dist = CustomJSONField()
+    fc_dist = CustomJSONField()
+
+    class Meta:
+        primary_key = peewee.CompositeKey("song_id", "level")
+        db_table = camel_to_snake("LocalChartStat")
+
+
 class ChartRecord(BaseDatabase):
     player_id = peewee.CharField()  # 登录用户名
     song_id = peewee.IntegerField()
@@ -172,9 +255,21 @@ class ChartVoting(BaseDatabase):
     class Meta:
         primary_key = peewee.CompositeKey("player_id", "song_id", "level")
         db_table = camel_to_snake("ChartVoting")
+        indexes = ((("song_id", "level"), False),)  # 按谱面统计投票数
+
+
+class ChartVoteChange(BaseDatabase):
+    # 点赞/点踩数有变化的谱面，各worker据此只重新读取这些谱面的计数，旧记录定期清理
+    song_id = peewee.BigIntegerField()
+    level = peewee.IntegerField()
+    time = peewee.DoubleField(index=True)
+
+    class Meta:
+        db_table = camel_to_snake("ChartVoteChange")
 
 
 class ExceptionRecord(BaseDatabase):
+    # 逐条的异常记录；新的未处理异常写入ExceptionFingerprint与ExceptionOccurrence
     id = peewee.CharField(primary_key=True)  # traceid
     type = peewee.CharField()  # 异常类型
     brief = peewee.CharField()  # 异常详情
@@ -183,3 +278,25 @@ class ExceptionRecord(BaseDatabase):
 
     class Meta:
         db_table = camel_to_snake("ExceptionRecord")
+
+
+class ExceptionFingerprint(BaseDatabase):
+    fingerprint = peewee.CharField(primary_key=True)  # 异常类型与栈帧的指纹
+    type = peewee.CharField()  # 异常类型
+    brief = peewee.CharField()  # 最近一次的异常详情
+    traceback = LongText()  # 首次出现时的堆栈跟踪
+    count = peewee.BigIntegerField(default=0)  # 累计出现次数
+    first_seen = peewee.TimestampField()
+    last_seen = peewee.TimestampField()
+
+    class Meta:
+        db_table = camel_to_snake("ExceptionFingerprint")
+
+
+class ExceptionOccurrence(BaseDatabase):
+    id = peewee.CharField(primary_key=True)  # traceid
+    fingerprint = peewee.CharField(index=True)
+    time = peewee.TimestampField()
+
+    class Meta:
+        db_table = camel_to_snake("ExceptionOccurrence")
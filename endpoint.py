@@ -1,41 +1,108 @@
+import datetime
 import hashlib
+import heapq
+import hmac
+import itertools
+import math
+import os
 import typing
+from decimal import Decimal
 from typing import Awaitable, Callable
 
-from fastapi import APIRouter, BackgroundTasks, Depends, Request
+from fastapi import APIRouter, BackgroundTasks, Depends, Header, Request
 from starlette.middleware.base import BaseHTTPMiddleware
-from starlette.responses import JSONResponse, Response, StreamingResponse
-
+from starlette.responses import (
+    JSONResponse,
+    PlainTextResponse,
+    Response,
+    StreamingResponse,
+)
+
+import metrics
 from core import *
+from database import query_stats
+from exception import InvalidTokenError, NoSuchJobError
 from model import *
+from profiler import event_loop_lag_monitor, sampling_profiler
+from tracing import span, tracer
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+async def verify_secret_key(x_secret_key: Optional[str] = Header(None)):
+    if x_secret_key is None or not hmac.compare_digest(
+        x_secret_key, config.app.secret_key
+    ):
+        raise InvalidTokenError
+
 
 charts_router = APIRouter(prefix="/api/v1/maimai/charts")
 player_router = APIRouter(prefix="/api/v1/maimai/player")
+admin_router = APIRouter(
+    prefix="/api/v1/maimai/admin", dependencies=[Depends(verify_secret_key)]
+)
+health_router = APIRouter()
+
+
+def _json_default(obj):
+    # orjson与标准库共用的类型转换
+    if isinstance(obj, np.ndarray):
+        return obj.tolist()
+    if isinstance(obj, np.generic):
+        return obj.item()
+    if isinstance(obj, Decimal):
+        return float(obj)
+    if isinstance(obj, (set, frozenset)):
+        return list(obj)
+    if isinstance(obj, (datetime.date, datetime.datetime)):
+        return obj.isoformat()
+    if isinstance(obj, BaseModel):
+        return obj.dict()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
 
 
 class CustomJSONEncoder(json.JSONEncoder):
     def default(self, obj):
-        if isinstance(obj, np.integer):
-            return int(obj)
-        elif isinstance(obj, np.floating):
-            return float(obj)
-        elif isinstance(obj, np.ndarray):
-            return obj.tolist()
-        elif isinstance(obj, np.generic):
-            return obj.item()
-        return super().default(obj)
+        return _json_default(obj)
 
 
 class CustomJSONResponse(JSONResponse):
+    """默认的响应类，优先使用orjson（原生支持numpy），未安装时退回标准库"""
+
     def render(self, content: typing.Any) -> bytes:
-        return json.dumps(
-            content,
-            ensure_ascii=False,
-            allow_nan=False,
-            indent=None,
-            separators=(",", ":"),
-            cls=CustomJSONEncoder,
-        ).encode("utf-8")
+        with span("serialize"):
+            if orjson is not None:
+                return orjson.dumps(
+                    content,
+                    default=_json_default,
+                    option=orjson.OPT_SERIALIZE_NUMPY | orjson.OPT_NON_STR_KEYS,
+                )
+            return json.dumps(
+                content,
+                ensure_ascii=False,
+                allow_nan=False,
+                indent=None,
+                separators=(",", ":"),
+                cls=CustomJSONEncoder,
+            ).encode("utf-8")
+
+
+def json_response(
+    data: typing.Any = "",
+    code: int = 0,
+    message: str = "ok",
+    status_code: int = 200,
+    headers: Optional[dict] = None,
+) -> CustomJSONResponse:
+    # 直接序列化，不经过pydantic校验与jsonable_encoder
+    return CustomJSONResponse(
+        {"code": code, "data": data, "message": message},
+        status_code=status_code,
+        headers=headers,
+    )
 
 
 import time
@@ -86,18 +153,24 @@ class ThrottlingMiddleware(BaseHTTPMiddleware):
         self.rate_limiter = RateLimiter(default_rate, default_capacity)
 
     async def dispatch(self, request: Request, call_next):
+        path = str(request.url.path)
+        if not path.startswith("/api/"):
+            # /ready、/metrics等由探针与监控频繁访问，不计入限流
+            return await call_next(request)
+
         # If the request is forwarded from a proxy server like Nginx,
         # we should get the client's original IP from 'x-forwarded-for' header.
         client_ip = request.headers.get("x-forwarded-for") or request.client.host
 
-        path = str(request.url.path)
         client_path = path + client_ip  # combining path and client ip
 
         rate = self.config.get(path, {}).get("rate", self.default_rate)
         capacity = self.config.get(path, {}).get("capacity", self.default_capacity)
-        bucket = self.rate_limiter.get_bucket(client_path, rate, capacity)
+        with span("throttle"):
+            bucket = self.rate_limiter.get_bucket(client_path, rate, capacity)
+            allowed = bucket.consume()
 
-        if not bucket.consume():
+        if not allowed:
             retry_after = int(1 / rate)
             response = JSONResponse(
                 content=GeneralResponseModel(
@@ -116,6 +189,211 @@ async def async_generator(body):
     yield body
 
 
+_route_templates = None  # endpoint -> 路由模板
+
+
+def route_template(request: Request) -> str:
+    # 以路由模板而非实际路径标记请求，避免路径参数产生过多标签
+    global _route_templates
+    if _route_templates is None:
+        _route_templates = {
+            getattr(route, "endpoint", None): route.path for route in request.app.routes
+        }
+    return _route_templates.get(request.scope.get("endpoint"), "<unmatched>")
+
+
+class MetricsMiddleware(BaseHTTPMiddleware):
+    """记录各路由的耗时，以及请求内执行的SQL数与数据库耗时"""
+
+    async def dispatch(self, request: Request, call_next):
+        start = time.perf_counter()
+        usage = metrics.begin_request()
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            return response
+        finally:
+            route = route_template(request)
+            metrics.http_request_duration.observe(
+                time.perf_counter() - start, request.method, route, status
+            )
+            metrics.request_db_queries.observe(usage[0], route)
+            metrics.request_db_duration.observe(usage[1], route)
+
+
+class TracingMiddleware(BaseHTTPMiddleware):
+    """
+    为每个请求生成trace_id并按采样率记录span树。
+    被采样的请求在响应头中带上X-Trace-Id，启用server_timing时还会带上Server-Timing。
+    """
+
+    async def dispatch(self, request: Request, call_next):
+        trace = tracer.begin()
+        request.state.trace_id = trace.trace_id  # 供500错误处理记录异常时使用
+        status = 500
+        try:
+            response = await call_next(request)
+            status = response.status_code
+            if trace.sampled:
+                response.headers["X-Trace-Id"] = trace.trace_id
+                if tracer.server_timing:
+                    response.headers["Server-Timing"] = trace.server_timing()
+            return response
+        finally:
+            tracer.finish(
+                trace,
+                method=request.method,
+                route=route_template(request),
+                path=request.url.path,
+                status=status,
+            )
+
+
+class PriorityGate:
+    """
+    各路由类别共享的执行名额。名额用尽时按优先级排队，
+    名额空出时交给优先级最高（数值最小）、最早到达的等待者，廉价接口不必排在昂贵接口之后。
+    """
+
+    def __init__(self, capacity: int):
+        self.capacity = capacity
+        self.running = 0
+        self._waiters = []  # (优先级, 到达顺序, future)
+        self._order = itertools.count()
+
+    async def acquire(self, priority: int, timeout: float) -> bool:
+        if self.running < self.capacity:
+            self.running += 1
+            return True
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._waiters, (priority, next(self._order), future))
+        try:
+            # 超时或请求被取消时future随之取消，release会跳过它
+            await asyncio.wait_for(future, timeout)
+            return True
+        except BaseException as e:
+            if future.done() and not future.cancelled():
+                # 名额已交给本请求但未能使用，转交给下一个等待者
+                self.release()
+            if isinstance(e, asyncio.TimeoutError):
+                return False
+            raise
+
+    def release(self) -> None:
+        # 直接把名额交给下一个等待者，running不变
+        while self._waiters:
+            _, _, future = heapq.heappop(self._waiters)
+            if not future.done():
+                future.set_result(None)
+                return
+        self.running -= 1
+
+
+class AdmissionLimiter:
+    """
+    单个路由类别的并发限制：最多concurrency个请求同时执行，最多queue个请求排队。
+    按近期平均耗时估算排队时间，预计超过max_wait时立即拒绝，而不是等到超时。
+    通过类别限制后还需从共享的PriorityGate取得名额，按priority决定先后。
+    """
+
+    def __init__(
+        self,
+        concurrency: int,
+        queue: int,
+        max_wait: float,
+        priority: int,
+        gate: PriorityGate,
+    ):
+        self.concurrency = concurrency
+        self.queue = queue
+        self.max_wait = max_wait
+        self.priority = priority
+        self.gate = gate
+        self.running = 0
+        self.waiting = 0
+        self.service_time = 0.0  # 请求耗时的指数移动平均
+        self._semaphore = asyncio.Semaphore(concurrency)
+
+    def should_shed(self) -> bool:
+        if self.waiting >= self.queue:
+            return True
+        expected_wait = (self.waiting + 1) / self.concurrency * self.service_time
+        return expected_wait > self.max_wait
+
+    async def acquire(self) -> bool:
+        deadline = time.monotonic() + self.max_wait
+        if not self._semaphore.locked():
+            await self._semaphore.acquire()  # 有空闲名额时不会挂起
+        elif self.should_shed():
+            return False
+        else:
+            self.waiting += 1
+            try:
+                await asyncio.wait_for(self._semaphore.acquire(), self.max_wait)
+            except asyncio.TimeoutError:
+                return False
+            finally:
+                self.waiting -= 1
+        try:
+            admitted = await self.gate.acquire(
+                self.priority, max(deadline - time.monotonic(), 0.001)
+            )
+        except BaseException:
+            self._semaphore.release()
+            raise
+        if not admitted:
+            self._semaphore.release()
+            return False
+        self.running += 1
+        return True
+
+    def release(self, elapsed: float) -> None:
+        self.running -= 1
+        self.service_time += (elapsed - self.service_time) * 0.1
+        self.gate.release()
+        self._semaphore.release()
+
+
+class AdmissionControlMiddleware(BaseHTTPMiddleware):
+    """
+    按路由类别分别限制并发，昂贵的接口排满时不会占用廉价接口的名额；
+    各类别再共享总的执行名额，名额紧张时优先放行priority高的类别（默认为廉价接口）。
+    只对/api/下的路由生效。
+    """
+
+    def __init__(self, app, config: AdmissionConfigModel):
+        super().__init__(app)
+        self.config = config
+        gate = PriorityGate(config.total_concurrency)
+        self.limiters = {
+            name: AdmissionLimiter(i.concurrency, i.queue, i.max_wait, i.priority, gate)
+            for name, i in config.classes.items()
+        }
+
+    async def dispatch(self, request: Request, call_next):
+        path = request.url.path
+        if not path.startswith("/api/"):
+            return await call_next(request)
+        limiter_name = self.config.routes.get(path, self.config.default_class)
+        limiter = self.limiters[limiter_name]
+        with span("admission", route_class=limiter_name):
+            admitted = await limiter.acquire()
+        if not admitted:
+            return json_response(
+                {},
+                -503,
+                "服务器繁忙，请稍后重试",
+                status_code=503,
+                headers={"Retry-After": str(math.ceil(limiter.max_wait))},
+            )
+        start = time.perf_counter()
+        try:
+            return await call_next(request)
+        finally:
+            limiter.release(time.perf_counter() - start)
+
+
 class ETagMiddleware(BaseHTTPMiddleware):
     exclude_paths = ["/set_account"]
 
@@ -138,10 +416,11 @@ class ETagMiddleware(BaseHTTPMiddleware):
             return real_response
 
         if isinstance(real_response, StreamingResponse):
-            body = b"".join([part async for part in real_response.body_iterator])
+            with span("etag"):
+                body = b"".join([part async for part in real_response.body_iterator])
 
-            # Compute ETag
-            etag = hashlib.md5(body).hexdigest()
+                # Compute ETag
+                etag = hashlib.md5(body).hexdigest()
             if (
                 "if-none-match" in request.headers
                 and request.headers["if-none-match"] == etag
@@ -163,7 +442,8 @@ class ETagMiddleware(BaseHTTPMiddleware):
             body = real_response.body
 
             # Compute ETag
-            etag = hashlib.md5(body).hexdigest()
+            with span("etag"):
+                etag = hashlib.md5(body).hexdigest()
             if (
                 "if-none-match" in request.headers
                 and request.headers["if-none-match"] == etag
@@ -179,36 +459,54 @@ class ETagMiddleware(BaseHTTPMiddleware):
 @charts_router.get("/basic_info")
 async def _get_basic_info_frontend():
     basic_info = await get_basic_info_frontend()
-    return GeneralResponseModel(data=basic_info)
+    return json_response(basic_info)
 
 
 @charts_router.get("/difficulty_difference")
 async def _get_difficulty_difference(query: FilterModel = Depends()):
     result = await get_difficulty_difference(**query.dict())
-    return GeneralResponseModel(data=result)
+    return json_response(result)
 
 
 @charts_router.get("/biggest_deviation")
 async def _get_biggest_deviation_songs(query: CompFilterModel = Depends()):
     result = await get_biggest_deviation_songs(**query.dict())
-    return GeneralResponseModel(data=result)
+    return json_response(result)
 
 
 @charts_router.get("/relative_easy_hard")
 async def _get_relative_easy_or_hard_songs(query: FilterModel = Depends()):
     result = await get_relative_easy_or_hard_songs(**query.dict())
-    return GeneralResponseModel(data=result)
+    return json_response(result)
 
 
 @charts_router.get("/most_popular")
 async def _get_most_popular_songs(query: CompFilterModel = Depends()):
     result = await get_most_popular_songs(**query.dict())
-    return GeneralResponseModel(data=result)
+    return json_response(result)
+
+
+@charts_router.get("/similar")
+async def _get_similar_charts(query: SimilarChartsModel = Depends()):
+    result = await get_similar_charts(**query.dict())
+    return json_response(result)
+
+
+@charts_router.get("/search")
+async def _search_charts(query: SearchSongsModel = Depends()):
+    result = await search_charts(**query.dict())
+    return json_response(result)
+
+
+@charts_router.get("/community_stat")
+async def _get_community_stat(query: CommunityStatModel = Depends()):
+    result = await get_community_stat(**query.dict())
+    return json_response(result)
 
 
 @charts_router.get("/all_level_stat")
 async def _get_all_level_stat():
-    return GeneralResponseModel(data=await get_all_level_stat())
+    return json_response(await get_all_level_stat())
 
 
 @player_router.get("/recommend_chart")
@@ -216,41 +514,111 @@ async def _recommend_chart(
     background_tasks: BackgroundTasks,
     query: RecommendChartsModel = Depends(),
 ):
-    query_result = await get_player_data_from_remote(query.bind_qq, query.username)
-    background_tasks.add_task(record_player_data, query_result)
-    recommend = await recommend_charts(query_result, query.preferences, query.limit)
-    return CustomJSONResponse({"code": 0, "data": recommend, "message": "ok"})
+    profile = await get_player_profile(player_id=query.username, bind_qq=query.bind_qq)
+    background_tasks.add_task(record_player_data, profile)
+    recommend = await recommend_charts(profile, query.preferences, query.limit)
+    return json_response(recommend)
+
+
+@player_router.get("/chart_percentile")
+async def _get_player_chart_percentile(query: PlayerInfoModel = Depends()):
+    profile = await get_player_profile(player_id=query.username, bind_qq=query.bind_qq)
+    result = await get_player_chart_percentile(profile)
+    return json_response(result)
 
 
 @player_router.post("/blacklist")
 async def _modify_blacklist(query: OperateBlacklistModel = Depends()):
     result = await operate_blacklist(**query.dict())
-    return GeneralResponseModel(data=result)
+    return json_response(result)
 
 
 @player_router.get("/blacklist")
 async def _get_blacklist(query: OnlyPlayeridModel = Depends()):
-    await operate_blacklist(**query.dict())
-    return GeneralResponseModel()
+    result = await get_blacklist(**query.dict())
+    return json_response(result)
 
 
 @player_router.post("/vote_songs")
 async def _vote_songs(query: VoteSongsModel = Depends()):
     await vote_songs(**query.dict())
-    return GeneralResponseModel()
+    return json_response()
 
 
 @player_router.get("/record")
 async def _get_player_record(query: OnlyPlayeridModel = Depends()):
     # TODO:流式传输/分页？
     result = await get_player_record(**query.dict())
-    return GeneralResponseModel(data=result)
+    return json_response(result)
 
 
 @player_router.post("/sync_record")
 async def _sync_player_record(query: PlayerInfoModel = Depends()):
-    # TODO:流式传输/分页？
-    query_result = await get_player_data_from_remote(query.bind_qq, query.username)
-    await record_player_data(query_result)
-    result = await get_player_record(query_result["username"])
-    return GeneralResponseModel(data=result)
+    # 提交同步任务后立即返回，通过任务状态查询进度与结果地址
+    result = await sync_job_queue.submit(query.username, query.bind_qq)
+    return json_response(result, status_code=202)
+
+
+@player_router.get("/sync_record/{job_id}")
+async def _get_sync_job(job_id: str):
+    result = await sync_job_queue.get(job_id)
+    if result is None:
+        raise NoSuchJobError
+    return json_response(result)
+
+
+@admin_router.post("/rebuild_votes")
+async def _rebuild_chart_votes():
+    await rebuild_chart_votes()
+    return json_response()
+
+
+@admin_router.post("/profile")
+async def _start_profile(query: ProfileModel = Depends()):
+    # 只分析处理本次请求的worker
+    result = sampling_profiler.start(query.duration, query.interval, query.cprofile)
+    return json_response(result, status_code=202)
+
+
+@admin_router.get("/profile")
+async def _get_profile():
+    return json_response(
+        {
+            "pid": os.getpid(),
+            "running": sampling_profiler.running,
+            "event_loop_lag": event_loop_lag_monitor.report(),
+            "last_result": sampling_profiler.last_result,
+        }
+    )
+
+
+@admin_router.get("/query_stats")
+async def _get_query_stats(query: QueryStatsModel = Depends()):
+    # 仅为处理本次请求的worker的统计
+    result = {
+        "pid": os.getpid(),
+        "threshold": query_stats.threshold,
+        "queries": query_stats.report(query.sort, query.limit),
+    }
+    return json_response(result)
+
+
+@admin_router.delete("/query_stats")
+async def _reset_query_stats():
+    query_stats.reset()
+    return json_response()
+
+
+@health_router.get("/ready")
+async def _get_readiness():
+    readiness = get_readiness()
+    if not all(readiness.values()):
+        return json_response(readiness, -503, "warming up", status_code=503)
+    return json_response(readiness)
+
+
+@health_router.get("/metrics")
+async def _get_metrics():
+    return PlainTextResponse(
+        metrics.registry.expose(), media_type="text/plain; version=0.0.4"
+    )
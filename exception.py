@@ -21,3 +21,17 @@ class NoSuchPlayerError(Error):
 class InvalidTokenError(Error):
     def __init__(self, message: str = "凭证无效"):
         self.message = message
+
+
+class ServiceBusyError(Error):
+    def __init__(self, message: str = "服务器繁忙，请稍后重试"):
+        self.message = message
+
+
+class ComputeBusyError(ServiceBusyError):
+    pass
+
+
+class NoSuchJobError(Error):
+    def __init__(self, message: str = "任务不存在或已过期"):
+        self.message = message
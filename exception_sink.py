@@ -0,0 +1,142 @@
+import hashlib
+import threading
+import time
+import traceback
+import uuid
+from typing import Dict, Optional
+
+from peewee import fn
+
+from database import ExceptionFingerprint, ExceptionOccurrence
+from log import logger
+
+MAX_PENDING = 1000  # 待写入的异常种类上限，超过后新种类的异常只计数不保存
+MAX_TRACE_IDS = 20  # 每批中每种异常最多保存的trace_id数，出现次数仍完整计数
+
+
+class PendingException:
+    __slots__ = ("type", "brief", "traceback", "count", "first_seen", "last_seen")
+
+    def __init__(self, e: BaseException, now: int):
+        self.type = type(e).__name__
+        self.brief = repr(e)[:255]
+        self.traceback = "".join(
+            traceback.format_exception(type(e), e, e.__traceback__)
+        )
+        self.count = 0
+        self.first_seen = now
+        self.last_seen = now
+
+
+def exception_fingerprint(e: BaseException) -> str:
+    # 由异常类型与各层栈帧的位置得到指纹，同一处抛出的同类异常指纹相同
+    frames = [
+        f"{frame.filename}:{frame.name}:{frame.lineno}"
+        for frame in traceback.extract_tb(e.__traceback__)
+    ]
+    source = "|".join([f"{type(e).__module__}.{type(e).__qualname__}", *frames])
+    return hashlib.sha1(source.encode()).hexdigest()
+
+
+class ExceptionSink:
+    """
+    请求中未处理的异常的汇总管道：出错时只在内存中按指纹累计并立即返回trace_id，
+    定期批量写入ExceptionFingerprint（每种异常一行，累计出现次数）与ExceptionOccurrence。
+    数据库不可用时同一种异常只占用一份内存，不会阻塞请求。
+    """
+
+    def __init__(self):
+        self._pending: Dict[str, PendingException] = {}
+        self._occurrences: list = []  # (trace_id, 指纹, 时间)
+        self._trace_ids: Dict[str, int] = {}  # 指纹 -> 本批已保存的trace_id数
+        self._dropped = 0  # 因超出上限而未保存的异常数
+        self._lock = threading.Lock()  # flush在调度器的线程池中执行
+
+    def record(self, e: BaseException, trace_id: Optional[str] = None) -> str:
+        trace_id = trace_id or uuid.uuid4().hex
+        now = int(time.time())
+        try:
+            key = exception_fingerprint(e)
+            with self._lock:
+                pending = self._pending.get(key)
+                if pending is None:
+                    if len(self._pending) >= MAX_PENDING:
+                        self._dropped += 1
+                        return trace_id
+                    pending = self._pending[key] = PendingException(e, now)
+                pending.count += 1
+                pending.last_seen = now
+                saved = self._trace_ids.get(key, 0)
+                if saved < MAX_TRACE_IDS:
+                    self._trace_ids[key] = saved + 1
+                    self._occurrences.append((trace_id, key, now))
+        except Exception:
+            logger.exception(f"Error encountered while recording exception {trace_id}")
+        return trace_id
+
+    def flush(self) -> None:
+        with self._lock:
+            pending, self._pending = self._pending, {}
+            occurrences, self._occurrences = self._occurrences, []
+            self._trace_ids = {}
+            dropped, self._dropped = self._dropped, 0
+        if dropped:
+            logger.warning(f"{dropped} exceptions dropped because the sink was full")
+        if not pending:
+            return
+        rows = [
+            {
+                "fingerprint": key,
+                "type": i.type,
+                "brief": i.brief,
+                "traceback": i.traceback,
+                "count": i.count,
+                "first_seen": i.first_seen,
+                "last_seen": i.last_seen,
+            }
+            for key, i in pending.items()
+        ]
+        try:
+            ExceptionFingerprint.insert_many(rows).on_conflict(
+                preserve=[ExceptionFingerprint.brief, ExceptionFingerprint.last_seen],
+                update={
+                    ExceptionFingerprint.count: ExceptionFingerprint.count
+                    + fn.VALUES(ExceptionFingerprint.count)
+                },
+            ).execute()
+        except Exception as e:
+            # 写入失败时把计数放回，下次再试；这一批的trace_id不再保留
+            self._restore(pending)
+            logger.exception(e)
+            logger.critical(f"Error <{e}> encountered while flushing exceptions")
+            return
+        if not occurrences:
+            return
+        try:
+            ExceptionOccurrence.insert_many(
+                occurrences,
+                fields=[
+                    ExceptionOccurrence.id,
+                    ExceptionOccurrence.fingerprint,
+                    ExceptionOccurrence.time,
+                ],
+            ).on_conflict_ignore().execute()
+        except Exception as e:
+            logger.exception(e)
+            logger.critical(f"Error <{e}> encountered while flushing exception traces")
+
+    def _restore(self, pending: Dict[str, PendingException]) -> None:
+        with self._lock:
+            for key, i in pending.items():
+                current = self._pending.get(key)
+                if current is None:
+                    if len(self._pending) >= MAX_PENDING:
+                        self._dropped += i.count
+                        continue
+                    self._pending[key] = i
+                else:
+                    current.count += i.count
+                    current.first_seen = min(current.first_seen, i.first_seen)
+
+
+exception_sink = ExceptionSink()
@@ -0,0 +1,66 @@
+import os
+from functools import wraps
+
+from database import config
+from log import logger
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+
+class LeaderElection:
+    """
+    以文件锁在同一台机器的worker中选出一个leader，只有leader执行拉取上游数据、写入数据库的任务。
+    锁随进程退出由系统释放，其余worker定期尝试获取锁以接替。
+    不支持文件锁的平台上每个进程都视为leader。
+    """
+
+    def __init__(self, path: str):
+        self.path = os.path.join(os.path.dirname(__file__), path)
+        self.is_leader = False
+        self._file = None
+
+    def try_acquire(self) -> bool:
+        """返回本次调用是否刚成为leader"""
+        if self.is_leader:
+            return False
+        if fcntl is None:
+            logger.warning("file lock unavailable, every worker will run ingest jobs")
+            self.is_leader = True
+            return True
+        os.makedirs(os.path.dirname(self.path), exist_ok=True)
+        file = open(self.path, "a+")
+        try:
+            fcntl.flock(file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            file.close()
+            return False
+        file.seek(0)
+        file.truncate()
+        file.write(str(os.getpid()))
+        file.flush()
+        self._file = file
+        self.is_leader = True
+        logger.info(f"worker {os.getpid()} elected as leader")
+        return True
+
+    def release(self) -> None:
+        if self._file is not None:
+            self._file.close()  # 关闭文件即释放锁
+            self._file = None
+        self.is_leader = False
+
+
+def leader_only(func):
+    # 包装定时任务，非leader时直接跳过
+    @wraps(func)
+    async def wrapped(*args, **kwargs):
+        if leader_election.is_leader:
+            return await func(*args, **kwargs)
+
+    return wrapped
+
+
+leader_election = LeaderElection(config.leader.lock_file)
@@ -1,4 +1,3 @@
-import uvicorn
 from apscheduler.schedulers.asyncio import AsyncIOScheduler
 from fastapi import FastAPI, Request
 from fastapi.exceptions import RequestValidationError
@@ -6,15 +5,34 @@ from pydantic import ValidationError
 from starlette.responses import JSONResponse
 
 from core import *
-from database import BaseDatabase, config, song_database
-from endpoint import ETagMiddleware, ThrottlingMiddleware, charts_router, player_router
+from database import BaseDatabase, config, query_stats, song_database
+from endpoint import (
+    AdmissionControlMiddleware,
+    CustomJSONResponse,
+    ETagMiddleware,
+    MetricsMiddleware,
+    ThrottlingMiddleware,
+    TracingMiddleware,
+    admin_router,
+    charts_router,
+    health_router,
+    player_router,
+)
 from exception import *
+from exception_sink import exception_sink
+from leader import leader_election, leader_only
 from log import logger
+from metrics import timed_job
+from profiler import event_loop_lag_monitor
+from tracing import tracer
 
-app = FastAPI(title="maibot")
+app = FastAPI(title="maibot", default_response_class=CustomJSONResponse)
 app.include_router(charts_router)
 app.include_router(player_router)
+app.include_router(admin_router)
+app.include_router(health_router)
 app.add_middleware(ETagMiddleware)
+app.add_middleware(AdmissionControlMiddleware, config=config.admission)
 app.add_middleware(
     ThrottlingMiddleware,
     default_rate=0.5,  # sets default to add 1 token for every 2 seconds
@@ -23,9 +41,23 @@ app.add_middleware(
         "/api/v1/maimai/player/sync_record": {"rate": 1 / 30, "capacity": 2},
     },
 )
+app.add_middleware(MetricsMiddleware)
+app.add_middleware(TracingMiddleware)
 scheduler = AsyncIOScheduler()
 
 
+def _create_missing_indexes(table) -> None:
+    # 已有的表不会随create_table补上后来新增的索引
+    existing = {
+        tuple(i.columns) for i in song_database.get_indexes(table._meta.table_name)
+    }
+    for index in table._meta.fields_to_index():
+        columns = tuple(i.column_name for i in index._expressions)
+        if columns not in existing:
+            song_database.execute(index.safe(False))
+            logger.info(f"Index {columns} of table <{table.__name__}> created.")
+
+
 @app.on_event("startup")
 async def initialize_database():
     logger.info(f"Initializing Database...")
@@ -37,6 +69,8 @@ async def initialize_database():
             if not table.table_exists():
                 table.create_table()
                 logger.info(f"Table <{table.__name__}> not exists, will be created.")
+            else:
+                _create_missing_indexes(table)
         except Exception as e:
             logger.exception(e)
             logger.critical(
@@ -45,41 +79,157 @@ async def initialize_database():
     song_database.close()
 
 
+@app.on_event("startup")
+async def initialize_chart_stat() -> None:
+    # 在开始接收成绩写入前完成社区谱面统计的初始化
+    try:
+        chart_stat_aggregator.initialize()
+    except Exception as e:
+        logger.exception(e)
+        logger.critical(f"Error <{e}> encountered while initializing chart stat")
+
+
 @app.on_event("startup")
 async def _check_update_on_startup() -> None:
-    update_new_song_id()
-    asyncio.create_task(check_update_on_startup())
+    # 已有其他worker发布的快照时直接使用，否则从数据库构建
+    if not sync_chart_data():
+        update_new_song_id()
+    await renew_leadership()
+
+
+async def renew_leadership() -> None:
+    # 成为leader后执行启动时的数据检查，之后的定时拉取任务也只在leader上执行
+    if leader_election.try_acquire():
+        asyncio.create_task(check_update_on_startup())
+
+
+@app.on_event("startup")
+async def start_compute_executor() -> None:
+    compute_executor.start(
+        config.compute.workers,
+        config.compute.max_pending,
+        config.compute.timeout,
+        get_catalog(),
+    )
+
+
+@app.on_event("startup")
+async def start_tracer() -> None:
+    tracer.start(
+        config.tracing.sample_rate,
+        config.tracing.file,
+        config.tracing.max_bytes,
+        config.tracing.backup_count,
+        config.tracing.server_timing,
+    )
+
+
+@app.on_event("shutdown")
+async def stop_tracer() -> None:
+    tracer.stop()
+
+
+@app.on_event("shutdown")
+async def stop_slow_query_log() -> None:
+    query_stats.stop()
+
+
+@app.on_event("startup")
+async def start_event_loop_lag_monitor() -> None:
+    event_loop_lag_monitor.start()
+
+
+@app.on_event("shutdown")
+async def stop_event_loop_lag_monitor() -> None:
+    await event_loop_lag_monitor.stop()
+
+
+@app.on_event("startup")
+async def start_sync_job_queue() -> None:
+    sync_job_queue.start(config.sync.workers, config.sync.max_queue, sync_player_record)
+
+
+@app.on_event("shutdown")
+async def stop_sync_job_queue() -> None:
+    await sync_job_queue.stop()
+
+
+@app.on_event("shutdown")
+async def flush_exception_sink() -> None:
+    exception_sink.flush()
+
+
+@app.on_event("shutdown")
+async def stop_compute_executor() -> None:
+    compute_executor.shutdown()
+    leader_election.release()
 
 
 @app.on_event("startup")
 async def check_update_regularly() -> None:
     scheduler.add_job(
-        check_song_update, "interval", hours=12, max_instances=1, misfire_grace_time=10
+        leader_only(timed_job(check_song_update)),
+        "interval",
+        hours=12,
+        max_instances=1,
+        misfire_grace_time=10,
     )
     # 谱面/歌曲信息12小时检查更新一次
     scheduler.add_job(
-        run_chart_stat_update,
+        leader_only(timed_job(run_chart_stat_update)),
         "interval",
         minutes=30,
         max_instances=1,
         misfire_grace_time=10,
     )  # 谱面/歌曲统计30分钟更新一次
     scheduler.add_job(
-        update_public_player_rating,
+        leader_only(timed_job(update_public_player_rating)),
         "interval",
         hours=12,
         max_instances=1,
         misfire_grace_time=10,
     )
+    scheduler.add_job(
+        timed_job(vote_rollup.flush), "interval", seconds=10, max_instances=1
+    )  # 点赞/点踩增量10秒写入一次
+    scheduler.add_job(
+        timed_job(exception_sink.flush), "interval", seconds=5, max_instances=1
+    )  # 未处理的异常5秒写入一次
+    scheduler.add_job(
+        timed_job(chart_stat_aggregator.reload),
+        "interval",
+        minutes=1,
+        max_instances=1,
+    )  # 重新加载其他worker写入的社区谱面统计
+    scheduler.add_job(
+        timed_job(sync_chart_data),
+        "interval",
+        seconds=config.snapshot.poll_interval,
+        max_instances=1,
+    )  # 切换到leader发布的谱面目录快照
+    scheduler.add_job(
+        renew_leadership,
+        "interval",
+        seconds=config.leader.retry_interval,
+        max_instances=1,
+    )  # leader退出后由其他worker接替
+    if shared_cache is not None:
+        scheduler.add_job(
+            timed_job(shared_cache.purge), "interval", minutes=10, max_instances=1
+        )  # 清理共享缓存中过期的条目
     scheduler.start()
 
 
 @app.exception_handler(NoSuchPlayerError)
+@app.exception_handler(NoSuchJobError)
 @app.exception_handler(404)
 async def _handle_404(request: Request, exc: Exception):
-    error_msg = (
-        "未找到玩家信息，请确认输入是否正确。" if isinstance(exc, NoSuchPlayerError) else f"未找到你所请求的网页。"
-    )
+    if isinstance(exc, NoSuchPlayerError):
+        error_msg = "未找到玩家信息，请确认输入是否正确。"
+    elif isinstance(exc, NoSuchJobError):
+        error_msg = exc.message
+    else:
+        error_msg = f"未找到你所请求的网页。"
     return JSONResponse(
         status_code=404,
         content={"code": -404, "data": {}, "message": error_msg},
@@ -112,7 +262,8 @@ async def _handle_401(request: Request, exc: Exception):
 
 @app.exception_handler(500)
 async def _handle_500(request: Request, exc: Exception):
-    trace_id = await record_exception(exc)
+    # 只在内存中记录，由定时任务批量写入数据库
+    trace_id = exception_sink.record(exc, getattr(request.state, "trace_id", None))
     return JSONResponse(
         status_code=500,
         content={
@@ -124,6 +275,16 @@ async def _handle_500(request: Request, exc: Exception):
     )
 
 
+@app.exception_handler(ServiceBusyError)
+async def _handle_503(request: Request, exc: ServiceBusyError):
+    return JSONResponse(
+        status_code=503,
+        content={"code": -503, "data": {}, "message": exc.message},
+        headers={"Retry-After": "1"},
+        media_type="application/json",
+    )
+
+
 @app.exception_handler(ValidationError)
 @app.exception_handler(ParameterError)
 @app.exception_handler(RequestValidationError)
@@ -148,6 +309,8 @@ async def _handle_422(request: Request, exc: Exception):
 
 
 if __name__ == "__main__":
+    import uvicorn
+
     uvicorn.run(
         app="main:app",
         host=str(config.unicorn.bind_address),
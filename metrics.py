@@ -0,0 +1,217 @@
+import asyncio
+import bisect
+import threading
+import time
+from contextvars import ContextVar
+from functools import wraps
+from typing import Dict, List, Optional, Sequence, Tuple
+
+# 耗时类指标默认的分桶（秒）
+LATENCY_BUCKETS = (
+    0.001,
+    0.0025,
+    0.005,
+    0.01,
+    0.025,
+    0.05,
+    0.1,
+    0.25,
+    0.5,
+    1.0,
+    2.5,
+    5.0,
+    10.0,
+    30.0,
+    60.0,
+)
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _escape(value) -> str:
+    return str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+
+
+def _format_labels(names: Sequence[str], values: Tuple, extra: str = "") -> str:
+    pairs = [f'{name}="{_escape(value)}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return "{" + ",".join(pairs) + "}" if pairs else ""
+
+
+class Counter:
+    def __init__(self, name: str, documentation: str, labelnames: Sequence[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values: Dict[Tuple, float] = {}
+        self._lock = threading.Lock()  # 调度器线程池中的任务也会记录指标
+
+    def inc(self, *labels, value: float = 1) -> None:
+        with self._lock:
+            self._values[labels] = self._values.get(labels, 0) + value
+
+    def expose(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} counter",
+        ]
+        with self._lock:
+            values = list(self._values.items())
+        for labels, value in values:
+            lines.append(
+                f"{self.name}{_format_labels(self.labelnames, labels)} {value}"
+            )
+        return lines
+
+
+class Histogram:
+    """只保存各分桶的计数、总和与样本数，记录一次只需一次二分查找"""
+
+    def __init__(
+        self,
+        name: str,
+        documentation: str,
+        labelnames: Sequence[str] = (),
+        buckets: Sequence[float] = LATENCY_BUCKETS,
+    ):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self.buckets = tuple(buckets)
+        self._values: Dict[Tuple, list] = {}  # labels -> [各分桶计数..., 总和, 样本数]
+        self._lock = threading.Lock()
+
+    def observe(self, value: float, *labels) -> None:
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(labels)
+            if state is None:
+                state = self._values[labels] = [0] * (len(self.buckets) + 2)
+            state[index] += 1
+            state[-2] += value
+            state[-1] += 1
+
+    def expose(self) -> List[str]:
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} histogram",
+        ]
+        with self._lock:
+            values = [(labels, state[:]) for labels, state in self._values.items()]
+        for labels, state in values:
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), state):
+                cumulative += count
+                le = f'le="{bound}"'
+                lines.append(
+                    f"{self.name}_bucket"
+                    f"{_format_labels(self.labelnames, labels, le)} {cumulative}"
+                )
+            label_text = _format_labels(self.labelnames, labels)
+            lines.append(f"{self.name}_sum{label_text} {state[-2]}")
+            lines.append(f"{self.name}_count{label_text} {state[-1]}")
+        return lines
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._metrics: list = []
+
+    def counter(self, *args, **kwargs) -> Counter:
+        metric = Counter(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def histogram(self, *args, **kwargs) -> Histogram:
+        metric = Histogram(*args, **kwargs)
+        self._metrics.append(metric)
+        return metric
+
+    def expose(self) -> str:
+        lines = []
+        for metric in self._metrics:
+            lines.extend(metric.expose())
+        return "\n".join(lines) + "\n"
+
+
+registry = MetricsRegistry()
+
+http_request_duration = registry.histogram(
+    "maibot_http_request_duration_seconds",
+    "HTTP请求耗时",
+    ["method", "route", "status"],
+)
+request_db_queries = registry.histogram(
+    "maibot_request_db_queries",
+    "单个请求执行的SQL数",
+    ["route"],
+    buckets=COUNT_BUCKETS,
+)
+request_db_duration = registry.histogram(
+    "maibot_request_db_duration_seconds", "单个请求的数据库总耗时", ["route"]
+)
+db_query_duration = registry.histogram("maibot_db_query_duration_seconds", "单条SQL的执行耗时")
+cache_requests = registry.counter(
+    "maibot_cache_requests_total", "缓存查询次数", ["cache", "result"]
+)
+cache_evictions = registry.counter(
+    "maibot_cache_evictions_total", "缓存因容量淘汰的条目数", ["cache"]
+)
+upstream_request_duration = registry.histogram(
+    "maibot_upstream_request_duration_seconds", "上游接口请求耗时", ["target", "outcome"]
+)
+job_duration = registry.histogram(
+    "maibot_job_duration_seconds", "定时任务耗时", ["job", "outcome"]
+)
+
+# 当前请求内的 [SQL数, 数据库耗时]，请求之外为None
+_request_db_usage: ContextVar[Optional[list]] = ContextVar(
+    "request_db_usage", default=None
+)
+
+
+def begin_request() -> list:
+    usage = [0, 0.0]
+    _request_db_usage.set(usage)
+    return usage
+
+
+def record_db_query(elapsed: float) -> None:
+    db_query_duration.observe(elapsed)
+    usage = _request_db_usage.get()
+    if usage is not None:
+        usage[0] += 1
+        usage[1] += elapsed
+
+
+def timed_job(func):
+    # 记录定时任务的耗时与结果，支持同步和异步函数
+    name = func.__name__
+
+    if asyncio.iscoroutinefunction(func):
+
+        @wraps(func)
+        async def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = await func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                job_duration.observe(time.perf_counter() - start, name, outcome)
+
+    else:
+
+        @wraps(func)
+        def wrapped(*args, **kwargs):
+            start = time.perf_counter()
+            outcome = "error"
+            try:
+                result = func(*args, **kwargs)
+                outcome = "ok"
+                return result
+            finally:
+                job_duration.observe(time.perf_counter() - start, name, outcome)
+
+    return wrapped
@@ -25,34 +25,105 @@ class AppConfigModel(BaseModel):
     secret_key: str
 
 
+class ComputeConfigModel(BaseModel):
+    workers: int = Field(2, ge=0)  # 计算进程数，为0时直接在事件循环中计算
+    max_pending: int = Field(32, gt=0)  # 排队中的计算任务上限
+    timeout: float = Field(10.0, gt=0)  # 单个计算任务的超时秒数
+
+
+class SnapshotConfigModel(BaseModel):
+    directory: str = "data/catalog"  # 谱面目录快照的存放目录（相对于程序目录）
+    keep: int = Field(3, gt=0)  # 保留的快照版本数
+    poll_interval: int = Field(5, gt=0)  # 检查新快照的间隔秒数
+
+
+class SharedCacheConfigModel(BaseModel):
+    enabled: bool = True
+    path: str = "data/cache.sqlite3"  # 各worker共享的缓存数据库（相对于程序目录）
+    lease: float = Field(10.0, gt=0)  # 计算租约的秒数，超时后其他worker可接手计算
+    poll_interval: float = Field(0.05, gt=0)  # 等待其他worker结果时的轮询间隔秒数
+
+
+class LeaderConfigModel(BaseModel):
+    lock_file: str = "data/leader.lock"  # 选举leader使用的锁文件（相对于程序目录）
+    retry_interval: int = Field(15, gt=0)  # 非leader尝试接替的间隔秒数
+
+
+class SyncConfigModel(BaseModel):
+    workers: int = Field(2, gt=0)  # 同时执行的成绩同步任务数
+    max_queue: int = Field(100, gt=0)  # 排队中的同步任务上限
+
+
+class AdmissionClassConfigModel(BaseModel):
+    concurrency: int = Field(gt=0)  # 同时执行的请求数
+    queue: int = Field(ge=0)  # 排队的请求数上限
+    max_wait: float = Field(gt=0)  # 预计排队超过该秒数时直接返回503
+    priority: int = 0  # 共享名额空出时数值小的类别优先
+
+
+class AdmissionConfigModel(BaseModel):
+    classes: Dict[str, AdmissionClassConfigModel] = {
+        "light": AdmissionClassConfigModel(
+            concurrency=64, queue=256, max_wait=1.0, priority=0
+        ),
+        "heavy": AdmissionClassConfigModel(
+            concurrency=8, queue=32, max_wait=5.0, priority=1
+        ),
+    }
+    total_concurrency: int = Field(64, gt=0)  # 各类别共享的同时执行请求数
+    routes: Dict[str, str] = {  # 路由 -> 类别，未列出的路由属于default_class
+        "/api/v1/maimai/player/recommend_chart": "heavy",
+        "/api/v1/maimai/player/record": "heavy",
+        "/api/v1/maimai/player/chart_percentile": "heavy",
+    }
+    default_class: str = "light"
+
+    @root_validator(skip_on_failure=True)
+    def check_classes(cls, values):
+        classes = values["classes"]
+        for name in [values["default_class"], *values["routes"].values()]:
+            if name not in classes:
+                raise ValueError(f"未定义的路由类别：{name}")
+        return values
+
+
+class TracingConfigModel(BaseModel):
+    sample_rate: float = Field(0.01, ge=0, le=1)  # 记录span的请求比例，为0时不记录
+    file: str = "log/trace.ndjson"  # 追踪记录文件（相对于程序目录）
+    max_bytes: int = Field(10 * 1024 * 1024, gt=0)  # 单个文件的大小上限，超过后轮转
+    backup_count: int = Field(5, ge=0)  # 保留的历史文件数
+    server_timing: bool = False  # 被采样的请求是否返回Server-Timing响应头
+
+
+class SlowQueryConfigModel(BaseModel):
+    threshold: float = Field(0.2, gt=0)  # 执行超过该秒数的SQL记为慢查询
+    file: str = "log/slow_query.log"  # 慢查询日志（相对于程序目录）
+    max_bytes: int = Field(10 * 1024 * 1024, gt=0)  # 单个文件的大小上限，超过后轮转
+    backup_count: int = Field(5, ge=0)  # 保留的历史文件数
+    explain: bool = False  # 是否为慢查询附上EXPLAIN结果
+    explain_interval: float = Field(600, gt=0)  # 同一种语句两次EXPLAIN的最小间隔秒数
+
+
 class ConfigModel(BaseModel):
     MySQL: DataBaseConfigModel
     unicorn: UnicornConfigModel
     app: AppConfigModel
+    compute: ComputeConfigModel = ComputeConfigModel()
+    snapshot: SnapshotConfigModel = SnapshotConfigModel()
+    shared_cache: SharedCacheConfigModel = SharedCacheConfigModel()
+    leader: LeaderConfigModel = LeaderConfigModel()
+    sync: SyncConfigModel = SyncConfigModel()
+    admission: AdmissionConfigModel = AdmissionConfigModel()
+    tracing: TracingConfigModel = TracingConfigModel()
+    slow_query: SlowQueryConfigModel = SlowQueryConfigModel()
 
 
 class PlayerPreferencesModel(BaseModel):
     recommend_preferences: Literal["aggressive", "balance", "conservative"] = "balance"
+    recommend_mode: Literal["difficulty", "rating_gain", "similar"] = "difficulty"
     exclude_played: bool = False
 
 
-class BasicChartInfoModel(BaseModel):
-    song_id: int = None
-    level: int = None
-
-    @root_validator(pre=True)
-    def move_data_to_root(cls, values):
-        data = values.pop("__data__", {})
-        values.update(data)
-        values.pop("_dirty", None)
-        values.pop("__rel__", None)
-        return values
-
-
-class RecommendChartsResultModel(BasicChartInfoModel):
-    vote: Optional[Literal[LIKE, DISLIKE, None]] = None
-
-
 class DiffStatDataModel(BaseModel):
     achievements: float
     dist: List[float]
@@ -63,10 +134,37 @@ class AllDiffStatDataModel(BaseModel):
     diff_data: Dict[str, DiffStatDataModel]
 
 
+class SimilarChartsModel(BaseModel):
+    song_id: int
+    level: int = Field(ge=1, le=5)
+    k: Optional[int] = Field(10, gt=0, le=100)
+
+
+class SearchSongsModel(BaseModel):
+    q: str = Field(min_length=1, max_length=100)
+    limit: Optional[int] = Field(10, gt=0, le=50)
+
+
+class CommunityStatModel(BaseModel):
+    song_id: Optional[int] = None
+    level: Optional[int] = Field(None, ge=1, le=5)
+
+
 class OnlyPlayeridModel(BaseModel):
     player_id: str
 
 
+class ProfileModel(BaseModel):
+    duration: float = Field(10.0, gt=0, le=60)  # 采样持续秒数
+    interval: float = Field(0.005, ge=0.001, le=0.1)  # 采样间隔秒数
+    cprofile: bool = False  # 是否同时启用cProfile（开销较大）
+
+
+class QueryStatsModel(BaseModel):
+    sort: Literal["count", "total", "avg", "p50", "p99", "max"] = "total"
+    limit: int = Field(50, gt=0, le=500)
+
+
 class TokenModel(BaseModel):
     access_token: str
     token_type: str
@@ -148,5 +246,5 @@ class VoteSongsModel(BaseModel):
 
     @validator("operate")
     def check_operate(cls, v):
-        if v is not None and v not in [LIKE, DISLIKE]:
+        if v is not None and v not in [LIKE, DISLIKE, RETRACT_VOTE]:
             raise ValueError("无效的operate")
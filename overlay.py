@@ -0,0 +1,122 @@
+import hashlib
+import json
+import time
+from typing import Dict, Optional, Set
+
+import numpy as np
+from cachetools import TTLCache
+
+from catalog import ChartCatalog
+from database import ChartBlacklist, ChartVoting
+from log import logger
+from shared_cache import shared_cache
+
+
+class PlayerOverlay:
+    """玩家个人数据：拉黑的谱面与投票，谱面以 song_id * 10 + level 表示"""
+
+    __slots__ = ("blacklist", "votes", "loaded")
+
+    def __init__(self, blacklist: Set[int], votes: Dict[int, int]):
+        self.blacklist = blacklist
+        self.votes = votes
+        self.loaded = time.time()
+
+    @property
+    def cache_key(self) -> str:
+        # 按内容生成，作为推荐结果缓存键的一部分；各worker上内容相同时键相同
+        content = json.dumps([sorted(self.blacklist), sorted(self.votes.items())])
+        return hashlib.md5(content.encode()).hexdigest()
+
+    def blacklist_mask(self, catalog: ChartCatalog) -> np.ndarray:
+        if not self.blacklist:
+            return np.zeros(len(catalog), dtype=bool)
+        return np.isin(
+            catalog.key, np.fromiter(self.blacklist, dtype=np.int64, count=-1)
+        )
+
+    def vote_of(self, song_id: int, level: int) -> Optional[int]:
+        return self.votes.get(song_id * 10 + level)
+
+
+class PlayerOverlayCache:
+    """
+    按玩家缓存拉黑与投票数据，首次访问时从数据库加载。
+    operate_blacklist / vote_songs 写入数据库后同步更新本进程已缓存的数据，
+    并在共享缓存中记录修改时间，其他worker在refresh时据此丢弃过期的数据；
+    未启用共享缓存时只能等待缓存ttl秒后过期重新加载。
+    """
+
+    def __init__(self, maxsize: int = 1000, ttl: float = 30):
+        self._cache = TTLCache(maxsize=maxsize, ttl=ttl)
+
+    async def refresh(self, player_id: str) -> None:
+        overlay = self._cache.get(player_id)
+        if overlay is None or shared_cache is None:
+            return
+        try:
+            found, changed = await shared_cache.get(self._shared_key(player_id))
+        except Exception as e:
+            logger.warning(f"Error <{e}> encountered while reading overlay version")
+            return
+        if found and changed >= overlay.loaded:
+            self._cache.pop(player_id, None)
+
+    def _publish_change(self, player_id: str) -> None:
+        if shared_cache is not None:
+            shared_cache.set_later(
+                self._shared_key(player_id), time.time(), self._cache.ttl
+            )
+
+    @staticmethod
+    def _shared_key(player_id: str) -> bytes:
+        return shared_cache.make_key("player_overlay", player_id)
+
+    def get(self, player_id: str) -> PlayerOverlay:
+        overlay = self._cache.get(player_id)
+        if overlay is None:
+            blacklist = {
+                song_id * 10 + level
+                for song_id, level in ChartBlacklist.select(
+                    ChartBlacklist.song_id, ChartBlacklist.level
+                )
+                .where(ChartBlacklist.player_id == player_id)
+                .tuples()
+            }
+            votes = {
+                song_id * 10 + level: vote
+                for song_id, level, vote in ChartVoting.select(
+                    ChartVoting.song_id, ChartVoting.level, ChartVoting.vote
+                )
+                .where(ChartVoting.player_id == player_id)
+                .tuples()
+            }
+            overlay = self._cache[player_id] = PlayerOverlay(blacklist, votes)
+        return overlay
+
+    def set_blacklisted(
+        self, player_id: str, song_id: int, level: int, blacklisted: bool
+    ) -> None:
+        self._publish_change(player_id)
+        overlay = self._cache.get(player_id)
+        if overlay is None:
+            return
+        if blacklisted:
+            overlay.blacklist.add(song_id * 10 + level)
+        else:
+            overlay.blacklist.discard(song_id * 10 + level)
+
+    def set_vote(
+        self, player_id: str, song_id: int, level: int, vote: Optional[int]
+    ) -> None:
+        self._publish_change(player_id)
+        overlay = self._cache.get(player_id)
+        if overlay is None:
+            return
+        if vote is None:
+            overlay.votes.pop(song_id * 10 + level, None)
+        else:
+            overlay.votes[song_id * 10 + level] = vote
+
+
+player_overlay_cache = PlayerOverlayCache()
@@ -0,0 +1,91 @@
+import hashlib
+from typing import Iterable, Optional
+
+import numpy as np
+
+RECORD_DTYPE = np.dtype(
+    [
+        ("song_id", np.int64),
+        ("level", np.int8),  # 1~5，与数据库一致
+        ("type", "U2"),  # DX / SD
+        ("achievement", np.float64),
+        ("rating", np.int32),
+        ("dxscore", np.int32),
+        ("fc", "U4"),
+        ("fs", "U4"),
+        ("is_new", bool),
+    ]
+)
+
+
+class PlayerProfile:
+    """
+    由查分器返回数据解析得到的玩家成绩，解析后只读。
+    成绩按rating降序排列，同一请求中的推荐、rating计算、同步与缓存都使用这一份数据。
+    """
+
+    __slots__ = (
+        "username",
+        "records",
+        "new_records",
+        "old_records",
+        "index",
+        "fingerprint",
+    )
+
+    def __init__(self, username: str, records: np.ndarray):
+        records = records[np.argsort(-records["rating"], kind="stable")]
+        records.flags.writeable = False
+        self.username = username
+        self.records = records
+        self.new_records = records[records["is_new"]]
+        self.old_records = records[~records["is_new"]]
+        self.new_records.flags.writeable = False
+        self.old_records.flags.writeable = False
+        self.index = {
+            (int(song_id), int(level)): i
+            for i, (song_id, level) in enumerate(
+                zip(records["song_id"], records["level"])
+            )
+        }
+        self.fingerprint = hashlib.blake2b(
+            username.encode() + records.tobytes(), digest_size=16
+        ).hexdigest()
+
+    @classmethod
+    def from_response(cls, data: dict, new_song_ids: Iterable[int]) -> "PlayerProfile":
+        new_song_ids = set(new_song_ids)
+        records = np.array(
+            [
+                (
+                    x["song_id"],
+                    x["level_index"] + 1,
+                    x["type"],
+                    x["achievements"],
+                    x["ra"],
+                    x["dxScore"],
+                    x["fc"],
+                    x["fs"],
+                    x["song_id"] in new_song_ids,
+                )
+                for x in data["records"]
+            ],
+            dtype=RECORD_DTYPE,
+        )
+        return cls(data["username"], records)
+
+    @property
+    def cache_key(self) -> str:
+        return self.fingerprint
+
+    @property
+    def old_rating(self) -> int:
+        return int(self.old_records["rating"][:35].sum())
+
+    @property
+    def new_rating(self) -> int:
+        return int(self.new_records["rating"][:15].sum())
+
+    def record_of(self, song_id: int, level: int) -> Optional[np.void]:
+        i = self.index.get((song_id, level))
+        return None if i is None else self.records[i]
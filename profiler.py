@@ -0,0 +1,175 @@
+import asyncio
+import cProfile
+import os
+import sys
+import threading
+import time
+from collections import Counter, deque
+from typing import Dict, Optional
+
+from exception import ServiceBusyError
+from log import LOG_PATH, logger
+
+
+class EventLoopLagMonitor:
+    """定期休眠固定时间，以实际唤醒时间晚于预期的部分作为事件循环延迟"""
+
+    def __init__(self, interval: float = 0.5, window: int = 120):
+        self.interval = interval
+        self.current = 0.0
+        self._samples = deque(maxlen=window)  # 最近window次测量
+        self._task: Optional[asyncio.Task] = None
+
+    def start(self) -> None:
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            start = loop.time()
+            await asyncio.sleep(self.interval)
+            self.current = max(0.0, loop.time() - start - self.interval)
+            self._samples.append(self.current)
+
+    def report(self) -> dict:
+        return {
+            "current_ms": round(self.current * 1000, 3),
+            "max_ms": round(max(self._samples, default=0.0) * 1000, 3),
+            "window_seconds": round(len(self._samples) * self.interval, 1),
+        }
+
+
+class SamplingProfiler:
+    """
+    按需启动的统计采样分析：后台线程每隔interval读取一次事件循环线程的调用栈，
+    持续duration秒后将折叠栈（可直接生成火焰图）写入log目录。
+    同一时间只允许一次分析，未运行时没有任何开销。
+    可选同时在事件循环线程上启用cProfile，开销较大，仅在分析期间生效。
+    """
+
+    def __init__(self):
+        self.running = False
+        self.last_result: Optional[dict] = None
+        self._labels: Dict[object, str] = {}  # code对象 -> 栈帧名，避免重复格式化
+
+    def start(self, duration: float, interval: float, with_cprofile: bool) -> dict:
+        # 需在事件循环线程中调用，被采样的就是调用方所在的线程
+        if self.running:
+            raise ServiceBusyError("已有正在进行的性能分析，请稍后重试")
+        self.running = True
+        name = f"profile-{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        profile = None
+        profile_done = threading.Event()
+        if with_cprofile:
+            profile = cProfile.Profile()
+            profile.enable()  # 只作用于当前线程，须在同一线程中停止
+
+            def stop_profile():
+                profile.disable()
+                profile_done.set()
+
+            asyncio.get_running_loop().call_later(duration, stop_profile)
+        threading.Thread(
+            target=self._run,
+            args=(
+                name,
+                threading.get_ident(),
+                duration,
+                interval,
+                profile,
+                profile_done,
+            ),
+            name="sampling-profiler",
+            daemon=True,
+        ).start()
+        return {
+            "name": name,
+            "pid": os.getpid(),
+            "duration": duration,
+            "interval": interval,
+            "cprofile": with_cprofile,
+        }
+
+    def _run(
+        self,
+        name: str,
+        thread_id: int,
+        duration: float,
+        interval: float,
+        profile: Optional[cProfile.Profile],
+        profile_done: threading.Event,
+    ) -> None:
+        try:
+            stacks = self._sample(thread_id, duration, interval)
+            result = {
+                "name": name,
+                "finished": round(time.time(), 3),
+                "samples": sum(stacks.values()),
+                "collapsed_file": self._write_collapsed(name, stacks),
+                "cprofile_file": None,
+                "top": self._top_functions(stacks),
+            }
+            if profile is not None:
+                # 事件循环被阻塞时cProfile无法按时停止，最多再等待duration秒
+                if profile_done.wait(duration):
+                    path = os.path.join(LOG_PATH, f"{name}.prof")
+                    profile.dump_stats(path)
+                    result["cprofile_file"] = path
+                else:
+                    logger.warning(f"cProfile of {name} did not stop in time")
+            self.last_result = result
+            logger.info(f"profile {name} finished with {result['samples']} samples")
+        except Exception as e:
+            logger.exception(e)
+        finally:
+            self.running = False
+
+    def _sample(self, thread_id: int, duration: float, interval: float) -> Counter:
+        stacks = Counter()
+        deadline = time.monotonic() + duration
+        while time.monotonic() < deadline:
+            frame = sys._current_frames().get(thread_id)
+            codes = []
+            while frame is not None:
+                codes.append(frame.f_code)
+                frame = frame.f_back
+            stacks[tuple(reversed(codes))] += 1
+            time.sleep(interval)
+        return stacks
+
+    def _label(self, code) -> str:
+        label = self._labels.get(code)
+        if label is None:
+            label = self._labels[
+                code
+            ] = f"{os.path.basename(code.co_filename)}:{code.co_name}"
+        return label
+
+    def _write_collapsed(self, name: str, stacks: Counter) -> str:
+        path = os.path.join(LOG_PATH, f"{name}.collapsed")
+        with open(path, "w", encoding="utf8") as f:
+            for codes, count in stacks.most_common():
+                f.write(f"{';'.join(self._label(i) for i in codes)} {count}\n")
+        return path
+
+    def _top_functions(self, stacks: Counter, limit: int = 10) -> list:
+        # 按栈顶函数（自身耗时）汇总的前几项
+        leaves = Counter()
+        for codes, count in stacks.items():
+            if codes:
+                leaves[self._label(codes[-1])] += count
+        total = sum(leaves.values()) or 1
+        return [
+            {"function": label, "samples": count, "ratio": round(count / total, 4)}
+            for label, count in leaves.most_common(limit)
+        ]
+
+
+event_loop_lag_monitor = EventLoopLagMonitor()
+sampling_profiler = SamplingProfiler()
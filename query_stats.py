@@ -0,0 +1,205 @@
+import hashlib
+import json
+import logging
+import math
+import os
+import queue
+import re
+import threading
+import time
+from collections import deque
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Optional
+
+from tracing import current_trace_id
+
+MAX_FINGERPRINTS = 2000  # 超过后新的语句形态归入OTHER，避免占用过多内存
+SAMPLE_SIZE = 1000  # 每种语句保留最近的耗时样本数，用于计算分位数
+OTHER = "<other>"
+
+_STRING = re.compile(r"'(?:[^'\\]|\\.|'')*'")
+_NUMBER = re.compile(r"\b\d+(?:\.\d+)?\b")
+_PLACEHOLDER_LIST = re.compile(r"\(\s*\?(?:\s*,\s*\?)*\s*\)")
+_REPEATED_LIST = re.compile(r"\(\.\.\.\)(?:\s*,\s*\(\.\.\.\))+")
+_SPACE = re.compile(r"\s+")
+
+
+def fingerprint(sql: str) -> str:
+    """将SQL中的常量、占位符与不定长的列表替换掉，同一形态的语句得到相同的指纹"""
+    sql = _STRING.sub("?", sql)
+    sql = sql.replace("%s", "?")
+    sql = _NUMBER.sub("?", sql)
+    sql = _PLACEHOLDER_LIST.sub("(...)", sql)
+    sql = _REPEATED_LIST.sub("(...)", sql)
+    return _SPACE.sub(" ", sql).strip()
+
+
+def _percentile(ordered: list, q: float) -> float:
+    return ordered[max(0, math.ceil(q * len(ordered)) - 1)]
+
+
+class FingerprintStats:
+    __slots__ = ("id", "fingerprint", "count", "total", "max", "slow", "samples")
+
+    def __init__(self, fingerprint: str):
+        self.id = hashlib.md5(fingerprint.encode()).hexdigest()[:12]
+        self.fingerprint = fingerprint
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+        self.slow = 0
+        self.samples = deque(maxlen=SAMPLE_SIZE)
+
+    def copy(self) -> "FingerprintStats":
+        stats = FingerprintStats.__new__(FingerprintStats)
+        for name in self.__slots__:
+            setattr(stats, name, getattr(self, name))
+        stats.samples = list(self.samples)
+        return stats
+
+    def to_dict(self) -> dict:
+        ordered = sorted(self.samples)
+        return {
+            "id": self.id,
+            "fingerprint": self.fingerprint,
+            "count": self.count,
+            "slow": self.slow,
+            "total_ms": round(self.total * 1000, 3),
+            "avg_ms": round(self.total / self.count * 1000, 3),
+            "p50_ms": round(_percentile(ordered, 0.5) * 1000, 3),
+            "p99_ms": round(_percentile(ordered, 0.99) * 1000, 3),
+            "max_ms": round(self.max * 1000, 3),
+        }
+
+
+class QueryStats:
+    """
+    按语句指纹统计SQL的执行次数与耗时（各worker分别统计）。
+    超过阈值的慢查询另外写入单独的日志文件，可选附上EXPLAIN结果。
+    查询可能在调度器的线程池中执行，统计数据的读写都在锁内进行；慢查询日志由单独的线程写入。
+    """
+
+    def __init__(
+        self,
+        threshold: float,
+        file: str,
+        max_bytes: int,
+        backup_count: int,
+        explain: bool,
+        explain_interval: float,
+    ):
+        self.threshold = threshold
+        self.explain = explain
+        self.explain_interval = explain_interval
+        self._stats: Dict[str, FingerprintStats] = {}
+        self._fingerprints: Dict[str, str] = {}  # 原始SQL -> 指纹，相同语句不必重复处理
+        self._explained: Dict[str, float] = {}  # 指纹id -> 上次EXPLAIN的时间
+        self._path = os.path.join(os.path.dirname(__file__), file)
+        self._max_bytes = max_bytes
+        self._backup_count = backup_count
+        self._logger: Optional[logging.Logger] = None
+        self._listener: Optional[QueueListener] = None
+        self._lock = threading.Lock()
+
+    def record(self, sql: str, elapsed: float) -> FingerprintStats:
+        with self._lock:
+            return self._record(sql, elapsed)
+
+    def _record(self, sql: str, elapsed: float) -> FingerprintStats:
+        key = self._fingerprints.get(sql)
+        if key is None:
+            if len(self._fingerprints) >= MAX_FINGERPRINTS * 4:
+                self._fingerprints.clear()
+            key = self._fingerprints[sql] = fingerprint(sql)
+        stats = self._stats.get(key)
+        if stats is None:
+            if len(self._stats) >= MAX_FINGERPRINTS:
+                key = OTHER
+            stats = self._stats.get(key)
+            if stats is None:
+                stats = self._stats[key] = FingerprintStats(key)
+        stats.count += 1
+        stats.total += elapsed
+        stats.max = max(stats.max, elapsed)
+        stats.samples.append(elapsed)
+        if elapsed >= self.threshold:
+            stats.slow += 1
+        return stats
+
+    def should_explain(self, stats: FingerprintStats, sql: str) -> bool:
+        # 只对SELECT语句执行EXPLAIN，同一指纹在explain_interval秒内只执行一次
+        if not self.explain or not sql.lstrip()[:6].upper() == "SELECT":
+            return False
+        now = time.monotonic()
+        with self._lock:
+            if now - self._explained.get(stats.id, -math.inf) < self.explain_interval:
+                return False
+            self._explained[stats.id] = now
+        return True
+
+    def log_slow(
+        self,
+        stats: FingerprintStats,
+        sql: str,
+        params,
+        elapsed: float,
+        plan: Optional[List[dict]] = None,
+    ) -> None:
+        line = {
+            "time": round(time.time(), 3),
+            "elapsed_ms": round(elapsed * 1000, 3),
+            "fingerprint_id": stats.id,
+            "trace_id": current_trace_id(),
+            "sql": sql,
+            "params": params[:50] if params else params,  # 批量写入时参数可能很多
+        }
+        if plan is not None:
+            line["explain"] = plan
+        self._get_logger().warning(json.dumps(line, ensure_ascii=False, default=str))
+
+    def _get_logger(self) -> logging.Logger:
+        with self._lock:
+            if self._logger is None:
+                self._logger = self._create_logger()
+            return self._logger
+
+    def _create_logger(self) -> logging.Logger:
+        os.makedirs(os.path.dirname(self._path), exist_ok=True)
+        handler = RotatingFileHandler(
+            self._path,
+            maxBytes=self._max_bytes,
+            backupCount=self._backup_count,
+            encoding="utf8",
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        # 写文件在单独的线程中进行，不阻塞执行查询的线程
+        records = queue.SimpleQueue()
+        self._listener = QueueListener(records, handler)
+        self._listener.start()
+        logger = logging.getLogger("maibot.slow_query")
+        logger.propagate = False
+        logger.addHandler(QueueHandler(records))
+        return logger
+
+    def stop(self) -> None:
+        with self._lock:
+            if self._listener is not None:
+                self._listener.stop()
+                self._listener = None
+            if self._logger is not None:
+                for handler in self._logger.handlers[:]:
+                    self._logger.removeHandler(handler)
+                self._logger = None
+
+    def report(self, sort: str = "total", limit: int = 50) -> List[dict]:
+        # sort为count、total、p99等，按该项从大到小排列
+        key = sort if sort == "count" else f"{sort}_ms"
+        with self._lock:
+            snapshot = [stats.copy() for stats in self._stats.values()]
+        result = [stats.to_dict() for stats in snapshot]
+        return sorted(result, key=lambda i: i[key], reverse=True)[:limit]
+
+    def reset(self) -> None:
+        with self._lock:
+            self._stats.clear()
+            self._explained.clear()
@@ -0,0 +1,120 @@
+from typing import Tuple
+
+import numpy as np
+
+from const import *
+
+_RATING_THRESHOLDS = np.array([i[0] for i in SONG_RATING_COEFFICIENT])
+_RATING_FACTORS = np.array([i[1] for i in SONG_RATING_COEFFICIENT])
+GRADE_BOUNDS = np.array(ACHIEVEMENT_GRADE_BOUNDS, dtype=np.float64)
+_GRADE_UPPER_BOUNDS = np.append(GRADE_BOUNDS[1:], 101.0)
+
+
+def compute_rating(difficulty, achievement) -> np.ndarray:
+    """按定数与达成率计算单曲rating，计算顺序与查分器一致以保证结果相同"""
+    difficulty = np.asarray(difficulty, dtype=np.float64)
+    achievement = np.minimum(np.asarray(achievement, dtype=np.float64), 100.5)
+    factor = _RATING_FACTORS[
+        np.searchsorted(_RATING_THRESHOLDS, achievement, side="right") - 1
+    ]
+    return np.floor(difficulty * (achievement / 100) * factor).astype(np.int64)
+
+
+def best_rating_floor(ratings, best_num: int) -> int:
+    """b35/b15已满时返回其中最低的rating，否则返回0（任何新成绩都能直接进入）"""
+    if len(ratings) < best_num:
+        return 0
+    return int(np.sort(ratings)[::-1][best_num - 1])
+
+
+def expected_rating_gain(
+    difficulty: np.ndarray,
+    current_rating: np.ndarray,
+    in_best: np.ndarray,
+    floor_rating: int,
+    achievement_dist: np.ndarray,
+    minium_achievement: float = 0,
+):
+    """
+    计算每张谱面达到各评级时可获得的rating提升，并按该谱面的评级分布加权求期望。
+    已在b35/b15中的谱面与自身当前成绩比较，其余谱面与b35/b15中最低的成绩比较。
+    返回 (期望提升, 最大可能提升)
+    """
+    tier_rating = compute_rating(difficulty[:, None], GRADE_BOUNDS[None, :])
+    baseline = np.where(in_best, current_rating, floor_rating)
+    gain = np.maximum(tier_rating - baseline[:, None], 0)
+    gain[:, GRADE_BOUNDS < minium_achievement] = 0
+
+    total = achievement_dist.sum(axis=1, keepdims=True)
+    probability = np.divide(
+        achievement_dist,
+        total,
+        out=np.zeros_like(achievement_dist, dtype=np.float64),
+        where=total > 0,
+    )
+    return (gain * probability).sum(axis=1), gain.max(axis=1)
+
+
+def achievement_percentile(
+    achievement_cdf: np.ndarray, positions: np.ndarray, achievement: np.ndarray
+) -> np.ndarray:
+    """
+    计算成绩在对应谱面全部玩家中的百分位（低于该成绩的玩家占比×100），
+    区间内按达成率线性插值。无统计数据的谱面返回nan。
+    """
+    achievement = np.asarray(achievement, dtype=np.float64)
+    grade = np.searchsorted(GRADE_BOUNDS, achievement, side="right") - 1
+    lower, upper = GRADE_BOUNDS[grade], _GRADE_UPPER_BOUNDS[grade]
+    fraction = np.clip((achievement - lower) / (upper - lower), 0, 1)
+    below = achievement_cdf[positions, grade]
+    within = achievement_cdf[positions, grade + 1] - below
+    percentile = (below + fraction * within) * 100
+    return np.where(achievement_cdf[positions, -1] > 0, percentile, np.nan)
+
+
+def rank_by_expected_gain(
+    catalog,
+    candidate_index: np.ndarray,
+    song_ids: np.ndarray,
+    levels: np.ndarray,
+    ratings: np.ndarray,
+    best_num: int,
+    minium_achievement: float,
+    limit: int,
+) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    在候选谱面中按期望rating提升排序。
+    song_ids/levels/ratings为玩家在该新旧曲范围内按rating降序排列的成绩，返回 (谱面位置, 期望提升)
+    """
+    positions = catalog.indices_of(song_ids, levels)
+    known = positions >= 0
+    current_rating = np.zeros(len(catalog), dtype=np.int64)
+    current_rating[positions[known]] = ratings[known]
+    in_best = np.zeros(len(catalog), dtype=bool)
+    best_positions = positions[:best_num]
+    in_best[best_positions[best_positions >= 0]] = True
+
+    expected_gain, _ = expected_rating_gain(
+        catalog.difficulty[candidate_index],
+        current_rating[candidate_index],
+        in_best[candidate_index],
+        best_rating_floor(ratings[:best_num], best_num),
+        catalog.achievement_dist[candidate_index],
+        minium_achievement,
+    )
+    order = np.argsort(-expected_gain, kind="stable")[:limit]
+    order = order[expected_gain[order] > 0]
+    return candidate_index[order], expected_gain[order]
+
+
+def chart_percentile(catalog, song_ids, levels, achievements) -> np.ndarray:
+    """批量计算成绩在对应谱面中的百分位，谱面不存在或无统计数据时为nan"""
+    positions = catalog.indices_of(song_ids, levels)
+    known = positions >= 0
+    percentile = np.full(len(positions), np.nan)
+    percentile[known] = achievement_percentile(
+        catalog.achievement_cdf,
+        positions[known],
+        np.asarray(achievements, dtype=np.float64)[known],
+    )
+    return percentile
@@ -0,0 +1,237 @@
+import asyncio
+import json
+from typing import Optional
+
+import numpy as np
+from peewee import Case, fn
+
+from catalog import ChartCatalog, get_catalog
+from database import ChartRecord, RatingRecord, SongDataVersion, song_database
+from log import logger
+from rating import compute_rating
+
+REBUILD_CHECKPOINT_KEY = "rating_rebuild_checkpoint"
+RECORD_CHUNK_SIZE = 5000
+PLAYER_CHUNK_SIZE = 200
+
+rating_rebuild_progress = {
+    "running": False,
+    "phase": None,
+    "processed": 0,
+    "total": 0,
+    "updated_records": 0,
+    "updated_players": 0,
+}
+
+
+def count_changed_charts(old: ChartCatalog, new: ChartCatalog) -> int:
+    """统计两份谱面目录中定数发生变化的谱面数量"""
+    positions = old.indices_of(new.song_id, new.level)
+    known = positions >= 0
+    return int(
+        np.count_nonzero(old.difficulty[positions[known]] != new.difficulty[known])
+    )
+
+
+def _load_checkpoint() -> Optional[dict]:
+    checkpoint = SongDataVersion.get_or_none(key=REBUILD_CHECKPOINT_KEY)
+    return json.loads(checkpoint.value) if checkpoint else None
+
+
+def _save_checkpoint(checkpoint: dict) -> None:
+    SongDataVersion.replace(
+        key=REBUILD_CHECKPOINT_KEY, value=json.dumps(checkpoint)
+    ).execute()
+
+
+def _rerate_record_chunk(catalog: ChartCatalog, rows: list) -> int:
+    record_id, song_id, level, achievement, rating = (np.array(x) for x in zip(*rows))
+    positions = catalog.indices_of(song_id, level)
+    known = positions >= 0
+    new_rating = rating.astype(np.int64)
+    new_rating[known] = compute_rating(
+        catalog.difficulty[positions[known]], achievement[known].astype(np.float64)
+    )
+    changed = np.flatnonzero(new_rating != rating)
+    if len(changed) == 0:
+        return 0
+    ChartRecord.update(
+        rating=Case(
+            ChartRecord.id,
+            [(int(record_id[i]), int(new_rating[i])) for i in changed],
+        )
+    ).where(ChartRecord.id << [int(record_id[i]) for i in changed]).execute()
+    return len(changed)
+
+
+def _rebuild_player_chunk(catalog: ChartCatalog, player_ids: list) -> int:
+    # 每张谱面取历史最高rating，再按新旧曲分别取b35/b15
+    best_ratings = {player_id: ([], []) for player_id in player_ids}
+    query = (
+        ChartRecord.select(
+            ChartRecord.player_id,
+            ChartRecord.song_id,
+            ChartRecord.level,
+            fn.MAX(ChartRecord.rating),
+        )
+        .where(ChartRecord.player_id << player_ids)
+        .group_by(ChartRecord.player_id, ChartRecord.song_id, ChartRecord.level)
+        .tuples()
+    )
+    rows = list(query)
+    if rows:
+        positions = catalog.indices_of([i[1] for i in rows], [i[2] for i in rows])
+        is_new = (positions >= 0) & catalog.is_new[positions]
+        for (player_id, _, _, rating), new_song in zip(rows, is_new):
+            best_ratings[player_id][1 if new_song else 0].append(rating)
+
+    latest_ids = (
+        RatingRecord.select(fn.MAX(RatingRecord.id))
+        .where(RatingRecord.player_id << player_ids)
+        .group_by(RatingRecord.player_id)
+    )
+    old_rating_cases, new_rating_cases = [], []
+    for record in RatingRecord.select().where(RatingRecord.id << latest_ids):
+        old_ratings, new_ratings = best_ratings[record.player_id]
+        if not (old_ratings or new_ratings):
+            continue
+        old_rating = sum(sorted(old_ratings, reverse=True)[:35])
+        new_rating = sum(sorted(new_ratings, reverse=True)[:15])
+        if (old_rating, new_rating) != (
+            record.old_song_rating,
+            record.new_song_rating,
+        ):
+            old_rating_cases.append((record.id, old_rating))
+            new_rating_cases.append((record.id, new_rating))
+    if old_rating_cases:
+        RatingRecord.update(
+            old_song_rating=Case(RatingRecord.id, old_rating_cases),
+            new_song_rating=Case(RatingRecord.id, new_rating_cases),
+        ).where(RatingRecord.id << [i[0] for i in old_rating_cases]).execute()
+    return len(old_rating_cases)
+
+
+def _rerate_next_records(catalog: ChartCatalog, checkpoint: dict) -> int:
+    """重算断点之后的一块成绩并推进断点，返回处理的成绩数，已处理完时返回0"""
+    rows = list(
+        ChartRecord.select(
+            ChartRecord.id,
+            ChartRecord.song_id,
+            ChartRecord.level,
+            ChartRecord.achievement,
+            ChartRecord.rating,
+        )
+        .where(ChartRecord.id > checkpoint["last_id"])
+        .order_by(ChartRecord.id)
+        .limit(RECORD_CHUNK_SIZE)
+        .tuples()
+    )
+    if not rows:
+        return 0
+    with song_database.atomic():
+        rating_rebuild_progress["updated_records"] += _rerate_record_chunk(
+            catalog, rows
+        )
+        checkpoint["last_id"] = rows[-1][0]
+        _save_checkpoint(checkpoint)
+    return len(rows)
+
+
+def _rebuild_next_players(catalog: ChartCatalog, checkpoint: dict) -> int:
+    """重建断点之后的一块玩家的RatingRecord并推进断点，返回处理的玩家数"""
+    player_ids = [
+        i[0]
+        for i in RatingRecord.select(RatingRecord.player_id)
+        .where(RatingRecord.player_id > checkpoint["last_player"])
+        .group_by(RatingRecord.player_id)
+        .order_by(RatingRecord.player_id)
+        .limit(PLAYER_CHUNK_SIZE)
+        .tuples()
+    ]
+    if not player_ids:
+        return 0
+    with song_database.atomic():
+        rating_rebuild_progress["updated_players"] += _rebuild_player_chunk(
+            catalog, player_ids
+        )
+        checkpoint["last_player"] = player_ids[-1]
+        _save_checkpoint(checkpoint)
+    return len(player_ids)
+
+
+async def run_rating_rebuild(data_version: Optional[str] = None) -> None:
+    """
+    谱面定数变化后，按新定数重算已保存的ChartRecord.rating，并重建各玩家最近一次的RatingRecord。
+    分块流式处理并把进度写入SongDataVersion，中断后再次调用会从断点继续。
+    """
+    if rating_rebuild_progress["running"]:
+        return
+    catalog = get_catalog()
+    if len(catalog) == 0:
+        return
+    checkpoint = _load_checkpoint()
+    if checkpoint is None or (
+        data_version is not None and checkpoint["version"] != data_version
+    ):
+        if data_version is None:
+            return
+        checkpoint = {
+            "version": data_version,
+            "phase": "records",
+            "last_id": 0,
+            "last_player": "",
+        }
+        _save_checkpoint(checkpoint)
+    logger.info(f"rebuilding chart ratings from checkpoint {checkpoint}")
+    rating_rebuild_progress.update(
+        running=True, processed=0, updated_records=0, updated_players=0
+    )
+    # 每块的查询与批量更新在线程池中执行，不阻塞leader的事件循环
+    loop = asyncio.get_running_loop()
+    try:
+        if checkpoint["phase"] == "records":
+            total = await loop.run_in_executor(
+                None,
+                ChartRecord.select()
+                .where(ChartRecord.id > checkpoint["last_id"])
+                .count,
+            )
+            rating_rebuild_progress.update(phase="records", total=total)
+            while True:
+                processed = await loop.run_in_executor(
+                    None, _rerate_next_records, catalog, checkpoint
+                )
+                if not processed:
+                    break
+                rating_rebuild_progress["processed"] += processed
+                logger.info(
+                    f"rebuilding chart ratings: {rating_rebuild_progress['processed']}"
+                    f"/{rating_rebuild_progress['total']} records"
+                )
+            checkpoint["phase"] = "players"
+            _save_checkpoint(checkpoint)
+
+        rating_rebuild_progress.update(phase="players", processed=0, total=0)
+        while True:
+            processed = await loop.run_in_executor(
+                None, _rebuild_next_players, catalog, checkpoint
+            )
+            if not processed:
+                break
+            rating_rebuild_progress["processed"] += processed
+            logger.info(
+                f"rebuilding rating records: {rating_rebuild_progress['processed']} players"
+            )
+
+        SongDataVersion.delete().where(
+            SongDataVersion.key == REBUILD_CHECKPOINT_KEY
+        ).execute()
+        logger.info(
+            f"rating rebuild finished, {rating_rebuild_progress['updated_records']} records "
+            f"and {rating_rebuild_progress['updated_players']} players updated"
+        )
+    except Exception as e:
+        logger.exception(e)
+        logger.critical(f"Error <{e}> encountered while rebuilding chart ratings")
+    finally:
+        rating_rebuild_progress["running"] = False
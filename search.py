@@ -0,0 +1,124 @@
+import math
+import unicodedata
+from typing import Dict, List, Optional
+
+import numpy as np
+
+from database import SongAlias, SongInfo
+from log import logger
+
+TITLE_WEIGHT = 1.0
+ALIAS_WEIGHT = 1.0
+ARTIST_WEIGHT = 0.5
+
+
+def normalize_text(text: str) -> str:
+    """全半角、大小写统一，并去掉空白与标点"""
+    text = unicodedata.normalize("NFKC", text).casefold()
+    return "".join(c for c in text if c.isalnum())
+
+
+def text_grams(text: str) -> set:
+    """字符二元组与三元组；过短的文本直接作为一个整体"""
+    if len(text) <= 2:
+        return {text} if text else set()
+    grams = {text[i : i + 2] for i in range(len(text) - 1)}
+    grams.update(text[i : i + 3] for i in range(len(text) - 2))
+    return grams
+
+
+def index_grams(text: str) -> set:
+    """建索引时另加入单字，单字查询也能命中较长的文本"""
+    return text_grams(text) | set(text)
+
+
+class SongSearchIndex:
+    """
+    歌曲模糊搜索索引：对曲名、曲师与别名建立字符n-gram倒排表，
+    按命中n-gram的idf加权求和排序，完全匹配或前缀匹配的曲名/别名额外加分。
+    """
+
+    def __init__(self, songs: List[tuple], aliases: Dict[int, List[str]]):
+        self.song_ids = np.array([i[0] for i in songs], dtype=np.int64)
+        self.titles = [i[1] for i in songs]
+        self.names = []  # 每首歌归一化后的曲名与别名
+        postings: Dict[str, Dict[int, float]] = {}
+        for doc, (song_id, title, artist) in enumerate(songs):
+            names = [normalize_text(title)]
+            names += [normalize_text(i) for i in aliases.get(song_id, [])]
+            self.names.append(names)
+            fields = [(name, TITLE_WEIGHT) for name in names[:1]]
+            fields += [(name, ALIAS_WEIGHT) for name in names[1:]]
+            fields.append((normalize_text(artist), ARTIST_WEIGHT))
+            for text, weight in fields:
+                for gram in index_grams(text):
+                    doc_weights = postings.setdefault(gram, {})
+                    doc_weights[doc] = max(doc_weights.get(doc, 0), weight)
+
+        self.postings = {}
+        for gram, doc_weights in postings.items():
+            idf = math.log(1 + len(songs) / len(doc_weights))
+            self.postings[gram] = (
+                np.fromiter(doc_weights.keys(), dtype=np.int64),
+                np.fromiter(doc_weights.values(), dtype=np.float64) * idf,
+                idf,
+            )
+
+    def search(self, query: str, limit: int = 10) -> List[dict]:
+        query = normalize_text(query)
+        matched = [self.postings[g] for g in text_grams(query) if g in self.postings]
+        if not matched:
+            return []
+        score = np.bincount(
+            np.concatenate([i[0] for i in matched]),
+            weights=np.concatenate([i[1] for i in matched]),
+            minlength=len(self.song_ids),
+        ) / sum(i[2] for i in matched)
+
+        candidates = np.flatnonzero(score)
+        top = candidates[np.argsort(-score[candidates], kind="stable")[: limit * 4]]
+        for i in top:
+            names = self.names[i]
+            if query in names:
+                score[i] += 1
+            elif any(name.startswith(query) for name in names):
+                score[i] += 0.5
+            elif any(query in name for name in names):
+                score[i] += 0.25
+        top = top[np.argsort(-score[top], kind="stable")][:limit]
+        return [
+            {
+                "song_id": int(self.song_ids[i]),
+                "song_title": self.titles[i],
+                "score": round(float(score[i]), 4),
+            }
+            for i in top
+        ]
+
+
+_search_index: Optional[SongSearchIndex] = None
+
+
+def refresh_search_index() -> None:
+    global _search_index
+    try:
+        songs = list(
+            SongInfo.select(SongInfo.song_id, SongInfo.song_title, SongInfo.artist)
+            .order_by(SongInfo.song_id)
+            .tuples()
+        )
+        aliases = {}
+        for alias, song_id in SongAlias.select(
+            SongAlias.alias, SongAlias.song_id
+        ).tuples():
+            aliases.setdefault(song_id, []).append(alias)
+        _search_index = SongSearchIndex(songs, aliases)
+    except Exception as e:
+        logger.exception(e)
+        logger.critical(f"Error <{e}> encountered while building song search index")
+
+
+def search_songs(query: str, limit: int = 10) -> List[dict]:
+    if _search_index is None:
+        return []
+    return _search_index.search(query, limit)
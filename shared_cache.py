@@ -0,0 +1,186 @@
+import asyncio
+import hashlib
+import os
+import pickle
+import sqlite3
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Optional, Tuple
+
+from database import config
+from log import logger
+
+_COMPRESS_THRESHOLD = 1024  # 序列化后超过该字节数时压缩
+_RAW, _ZLIB = b"\x00", b"\x01"
+
+
+def _dumps(value: Any) -> bytes:
+    data = pickle.dumps(value, protocol=pickle.HIGHEST_PROTOCOL)
+    if len(data) > _COMPRESS_THRESHOLD:
+        return _ZLIB + zlib.compress(data, 1)
+    return _RAW + data
+
+
+def _loads(data: bytes) -> Any:
+    if data[:1] == _ZLIB:
+        return pickle.loads(zlib.decompress(data[1:]))
+    return pickle.loads(data[1:])
+
+
+class SharedCache:
+    """
+    同一台机器上各worker共享的二级缓存，存放于WAL模式的SQLite中。
+    值以pickle序列化，较大的值再经zlib压缩；
+    未命中时以租约保证同一个键只由一个worker计算，其余worker等待其结果。
+    SQLite操作在单独的线程中按提交顺序执行，不阻塞事件循环；每个线程使用各自的连接。
+    """
+
+    def __init__(self, path: str, lease: float, poll_interval: float):
+        self.path = os.path.join(os.path.dirname(__file__), path)
+        self.lease = lease
+        self.poll_interval = poll_interval
+        self._local = threading.local()
+        self._executor: Optional[ThreadPoolExecutor] = None
+        self._pid = None
+
+    @property
+    def executor(self) -> ThreadPoolExecutor:
+        # fork出的子进程不能沿用父进程的线程
+        if self._executor is None or self._pid != os.getpid():
+            self._executor = ThreadPoolExecutor(1, thread_name_prefix="shared-cache")
+            self._pid = os.getpid()
+        return self._executor
+
+    @property
+    def connection(self) -> sqlite3.Connection:
+        # 每个线程各用一个连接；fork出的子进程不能沿用父进程的连接
+        if getattr(self._local, "pid", None) != os.getpid():
+            os.makedirs(os.path.dirname(self.path), exist_ok=True)
+            connection = sqlite3.connect(self.path, timeout=1, isolation_level=None)
+            connection.execute("PRAGMA journal_mode=WAL")
+            connection.execute("PRAGMA synchronous=NORMAL")
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_entry "
+                "(key BLOB PRIMARY KEY, value BLOB NOT NULL, expires REAL NOT NULL)"
+            )
+            connection.execute(
+                "CREATE TABLE IF NOT EXISTS cache_lease "
+                "(key BLOB PRIMARY KEY, owner INTEGER NOT NULL, expires REAL NOT NULL)"
+            )
+            self._local.connection, self._local.pid = connection, os.getpid()
+        return self._local.connection
+
+    @staticmethod
+    def make_key(namespace: str, key: str) -> bytes:
+        return hashlib.blake2b(f"{namespace}:{key}".encode(), digest_size=16).digest()
+
+    async def _call(self, func, *args):
+        return await asyncio.get_running_loop().run_in_executor(
+            self.executor, func, *args
+        )
+
+    async def get(self, key: bytes) -> Tuple[bool, Any]:
+        return await self._call(self._get, key)
+
+    async def set(self, key: bytes, value: Any, ttl: float) -> None:
+        await self._call(self._set, key, value, ttl)
+
+    def set_later(self, key: bytes, value: Any, ttl: float) -> None:
+        # 不等待写入完成，同一进程中的写入仍按调用顺序执行
+        def done(future):
+            if future.exception() is not None:
+                logger.warning(
+                    f"Error <{future.exception()}> encountered while writing shared cache"
+                )
+
+        self.executor.submit(self._set, key, value, ttl).add_done_callback(done)
+
+    def _get(self, key: bytes) -> Tuple[bool, Any]:
+        row = self.connection.execute(
+            "SELECT value FROM cache_entry WHERE key = ? AND expires > ?",
+            (key, time.time()),
+        ).fetchone()
+        if row is None:
+            return False, None
+        return True, _loads(row[0])
+
+    def _set(self, key: bytes, value: Any, ttl: float) -> None:
+        self.connection.execute(
+            "INSERT OR REPLACE INTO cache_entry (key, value, expires) VALUES (?, ?, ?)",
+            (key, _dumps(value), time.time() + ttl),
+        )
+
+    def _acquire(self, key: bytes) -> bool:
+        now = time.time()
+        with self.connection:
+            self.connection.execute("BEGIN IMMEDIATE")
+            self.connection.execute(
+                "DELETE FROM cache_lease WHERE key = ? AND expires <= ?", (key, now)
+            )
+            cursor = self.connection.execute(
+                "INSERT OR IGNORE INTO cache_lease (key, owner, expires) VALUES (?, ?, ?)",
+                (key, os.getpid(), now + self.lease),
+            )
+        return cursor.rowcount == 1
+
+    def _release(self, key: bytes) -> None:
+        self.connection.execute(
+            "DELETE FROM cache_lease WHERE key = ? AND owner = ?", (key, os.getpid())
+        )
+
+    def purge(self) -> None:
+        try:
+            now = time.time()
+            self.connection.execute(
+                "DELETE FROM cache_entry WHERE expires <= ?", (now,)
+            )
+            self.connection.execute(
+                "DELETE FROM cache_lease WHERE expires <= ?", (now,)
+            )
+        except sqlite3.Error as e:
+            logger.warning(f"Error <{e}> encountered while purging shared cache")
+
+    async def get_or_compute(self, key: bytes, ttl: float, compute):
+        """依次查询共享缓存、争取计算租约；拿不到租约时等待持有者写入结果"""
+        deadline = time.monotonic() + self.lease
+        while True:
+            try:
+                found, value = await self.get(key)
+                if found:
+                    return value
+                if await self._call(self._acquire, key):
+                    break
+            except Exception as e:
+                logger.warning(f"Error <{e}> encountered while reading shared cache")
+                return await compute()
+            if time.monotonic() >= deadline:
+                # 持有者迟迟没有写入结果（可能已退出），自行计算
+                return await compute()
+            await asyncio.sleep(self.poll_interval)
+
+        try:
+            value = await compute()
+            if value is not None:
+                try:
+                    await self.set(key, value, ttl)
+                except Exception as e:
+                    logger.warning(
+                        f"Error <{e}> encountered while writing shared cache"
+                    )
+            return value
+        finally:
+            try:
+                await self._call(self._release, key)
+            except sqlite3.Error as e:
+                logger.warning(f"Error <{e}> encountered while releasing cache lease")
+
+
+shared_cache: Optional[SharedCache] = None
+if config.shared_cache.enabled:
+    shared_cache = SharedCache(
+        config.shared_cache.path,
+        config.shared_cache.lease,
+        config.shared_cache.poll_interval,
+    )
@@ -0,0 +1,74 @@
+from typing import Optional, Tuple
+
+import numpy as np
+
+from catalog import ChartCatalog, get_catalog
+
+
+class SimilarityIndex:
+    """
+    谱面相似度索引：以物量构成（各类note占比与总物量）、拟合定数和成绩标准差为特征，
+    标准化后建立KD树，用于查找“与这张谱相似”的谱面。
+    只收录有统计数据的谱面。
+    """
+
+    def __init__(self, catalog: ChartCatalog):
+        self.catalog = catalog
+        self.positions = np.flatnonzero(catalog.has_stat)
+        notes = catalog.notes[self.positions].astype(np.float64)
+        total = notes.sum(axis=1, keepdims=True)
+        features = np.hstack(
+            [
+                np.divide(notes, total, out=np.zeros_like(notes), where=total > 0),
+                np.log1p(total),
+                catalog.fit_difficulty[self.positions, None],
+                catalog.std_dev[self.positions, None],
+            ]
+        )
+        std = features.std(axis=0)
+        self.features = (features - features.mean(axis=0)) / np.where(std > 0, std, 1)
+        # 谱面位置 -> 索引内行号
+        self.rows = np.full(len(catalog), -1, dtype=np.int64)
+        self.rows[self.positions] = np.arange(len(self.positions))
+        self.tree = None
+        if len(self.positions):
+            from scipy.spatial import cKDTree  # 延迟载入scipy，加快启动
+
+            self.tree = cKDTree(self.features)
+
+    def query(self, positions: np.ndarray, k: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        查询各谱面最相似的k张谱面（不含自身），返回 (距离, 谱面位置)，形状均为 (len(positions), k)，
+        不足k张时距离为inf、位置为-1
+        """
+        rows = self.rows[positions]
+        distances = np.full((len(positions), k), np.inf)
+        neighbours = np.full((len(positions), k), -1, dtype=np.int64)
+        indexed = np.flatnonzero(rows >= 0)
+        if self.tree is None or len(indexed) == 0:
+            return distances, neighbours
+        found_distances, found_rows = self.tree.query(
+            self.features[rows[indexed]], k=min(k + 1, len(self.positions))
+        )
+        found_distances = found_distances.reshape(len(indexed), -1)
+        found_rows = found_rows.reshape(len(indexed), -1)
+        for i, row, row_distances, row_neighbours in zip(
+            indexed, rows[indexed], found_distances, found_rows
+        ):
+            not_self = row_neighbours != row
+            result = row_neighbours[not_self][:k]
+            distances[i, : len(result)] = row_distances[not_self][:k]
+            neighbours[i, : len(result)] = self.positions[result]
+        return distances, neighbours
+
+
+_similarity_index: Optional[SimilarityIndex] = None
+
+
+def get_similarity_index() -> SimilarityIndex:
+    """谱面目录更新后首次访问时重建索引"""
+    global _similarity_index
+    catalog = get_catalog()
+    if _similarity_index is None or _similarity_index.catalog is not catalog:
+        _similarity_index = SimilarityIndex(catalog)
+    return _similarity_index
@@ -0,0 +1,97 @@
+from typing import Optional
+
+import numpy as np
+from cachetools import LRUCache
+
+from catalog import ChartCatalog, get_catalog
+from compute import compute_executor
+from const import *
+from player_profile import PlayerProfile
+
+_GENRE_NUM = len(SONG_GENRE) + 1  # 最后一列为未知流派
+_TYPE_NUM = 2
+_OFFSET_PENALTY = 1.0  # 流派/谱面类型偏移的岭回归惩罚，样本少时偏移趋近于0
+_MAX_ACHIEVEMENT = 101.0
+
+_skill_cache = LRUCache(maxsize=250)
+
+
+class SkillModel:
+    """
+    玩家实力模型，在logit空间对达成率做线性回归：
+    logit(达成率 / 101) = 截距 + 斜率 × 拟合定数 + 流派偏移 + 谱面类型偏移
+    """
+
+    def __init__(self, coef: np.ndarray):
+        self.coef = coef
+
+    @staticmethod
+    def _design_matrix(difficulty, genre, chart_type) -> np.ndarray:
+        n = len(difficulty)
+        x = np.zeros((n, 2 + _GENRE_NUM + _TYPE_NUM), dtype=np.float64)
+        x[:, 0] = 1
+        x[:, 1] = difficulty
+        x[np.arange(n), 2 + np.where(genre < 0, _GENRE_NUM - 1, genre)] = 1
+        x[np.arange(n), 2 + _GENRE_NUM + chart_type] = 1
+        return x
+
+    @classmethod
+    def fit(cls, difficulty, genre, chart_type, achievement) -> "SkillModel":
+        x = cls._design_matrix(difficulty, genre, chart_type)
+        y = np.clip(np.asarray(achievement) / _MAX_ACHIEVEMENT, 1e-3, 1 - 1e-4)
+        y = np.log(y / (1 - y))
+        penalty = np.full(x.shape[1], _OFFSET_PENALTY)
+        penalty[:2] = 1e-6
+        coef = np.linalg.solve(x.T @ x + np.diag(penalty), x.T @ y)
+        return cls(coef)
+
+    def predict(self, difficulty, genre, chart_type) -> np.ndarray:
+        logit = self._design_matrix(difficulty, genre, chart_type) @ self.coef
+        return _MAX_ACHIEVEMENT / (1 + np.exp(-logit))
+
+
+def fit_and_predict(
+    catalog: ChartCatalog, song_ids, levels, achievements
+) -> np.ndarray:
+    """拟合玩家实力模型并预测全部谱面的达成率，已游玩的谱面为nan"""
+    prediction = np.full(len(catalog), np.nan)
+    positions = catalog.indices_of(song_ids, levels)
+    known = positions >= 0
+    if np.count_nonzero(known) < 10:
+        return prediction
+    positions = positions[known]
+    achievements = np.asarray(achievements, dtype=np.float64)[known]
+    model = SkillModel.fit(
+        catalog.fit_difficulty[positions],
+        catalog.genre[positions],
+        catalog.chart_type[positions],
+        achievements,
+    )
+    unplayed = np.ones(len(catalog), dtype=bool)
+    unplayed[positions] = False
+    prediction[unplayed] = model.predict(
+        catalog.fit_difficulty[unplayed],
+        catalog.genre[unplayed],
+        catalog.chart_type[unplayed],
+    )
+    return prediction
+
+
+async def predict_player_achievement(
+    profile: PlayerProfile, catalog: Optional[ChartCatalog] = None
+) -> np.ndarray:
+    """按成绩指纹缓存的玩家实力预测，拟合在计算进程池中进行"""
+    if catalog is None:
+        catalog = get_catalog()
+    cached = _skill_cache.get(profile.fingerprint)
+    if cached is not None and cached[0] is catalog:
+        return cached[1]
+    prediction = await compute_executor.run(
+        fit_and_predict,
+        profile.records["song_id"],
+        profile.records["level"],
+        profile.records["achievement"],
+        catalog=catalog,
+    )
+    _skill_cache[profile.fingerprint] = (catalog, prediction)
+    return prediction
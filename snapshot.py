@@ -0,0 +1,130 @@
+import json
+import os
+import shutil
+import time
+from typing import Optional
+
+import numpy as np
+
+from catalog import ChartCatalog, set_catalog
+from database import config
+from log import logger
+
+SNAPSHOT_POINTER = "CURRENT"  # 指向当前版本的指针文件
+SNAPSHOT_META = "meta.json"
+
+
+class CatalogSnapshotStore:
+    """
+    谱面目录快照：每个版本是一个目录，每个数组保存为一个.npy文件。
+    写入完成后原子地替换指针文件发布新版本，各进程以只读方式映射当前版本，
+    同一台机器上的所有worker共享同一份页缓存。
+    """
+
+    def __init__(self, directory: str, keep: int):
+        self.directory = os.path.join(os.path.dirname(__file__), directory)
+        self.keep = keep
+
+    def _path(self, name: str) -> str:
+        return os.path.join(self.directory, name)
+
+    def current_version(self) -> Optional[str]:
+        try:
+            with open(self._path(SNAPSHOT_POINTER), "r", encoding="utf-8") as f:
+                return f.read().strip() or None
+        except FileNotFoundError:
+            return None
+
+    def publish(self, catalog: ChartCatalog, state: dict) -> str:
+        """state为随目录一同发布的其他派生数据，需可JSON序列化"""
+        os.makedirs(self.directory, exist_ok=True)
+        version = f"{time.time_ns()}-{os.getpid()}"
+        staging = self._path(f".{version}.tmp")
+        os.makedirs(staging)
+        for name, value in catalog.arrays.items():
+            np.save(os.path.join(staging, f"{name}.npy"), np.ascontiguousarray(value))
+        with open(os.path.join(staging, SNAPSHOT_META), "w", encoding="utf-8") as f:
+            json.dump({"version": version, "charts": len(catalog), "state": state}, f)
+        os.replace(staging, self._path(version))
+
+        pointer = self._path(f".{SNAPSHOT_POINTER}.{os.getpid()}.tmp")
+        with open(pointer, "w", encoding="utf-8") as f:
+            f.write(version)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(pointer, self._path(SNAPSHOT_POINTER))
+        self._prune(version)
+        return version
+
+    def load(self, version: str) -> ChartCatalog:
+        path = self._path(version)
+        arrays = {
+            name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode="r")
+            for name in ChartCatalog._empty_arrays()
+        }
+        return ChartCatalog(arrays, source=path)
+
+    def load_state(self, version: str) -> dict:
+        with open(
+            os.path.join(self._path(version), SNAPSHOT_META), "r", encoding="utf-8"
+        ) as f:
+            return json.load(f).get("state", {})
+
+    def _prune(self, current: str) -> None:
+        # 已映射的旧版本在POSIX上删除后仍可继续读取，删除失败（如Windows）时下次再试
+        versions = sorted(
+            (
+                i
+                for i in os.listdir(self.directory)
+                if not i.startswith(".") and i != SNAPSHOT_POINTER
+            ),
+            key=lambda i: os.path.getmtime(self._path(i)),
+            reverse=True,
+        )
+        for version in versions[self.keep :]:
+            if version != current:
+                shutil.rmtree(self._path(version), ignore_errors=True)
+
+
+snapshot_store = CatalogSnapshotStore(config.snapshot.directory, config.snapshot.keep)
+_loaded_version: Optional[str] = None
+
+
+def load_catalog_snapshot(path: str) -> ChartCatalog:
+    """计算进程等按快照目录直接映射谱面目录"""
+    store = CatalogSnapshotStore(os.path.dirname(path), 0)
+    return store.load(os.path.basename(path))
+
+
+def publish_catalog(catalog: ChartCatalog, state: dict) -> ChartCatalog:
+    """发布新的谱面目录快照，并把本进程的目录换成映射的版本"""
+    global _loaded_version
+    try:
+        version = snapshot_store.publish(catalog, state)
+        mapped = snapshot_store.load(version)
+    except Exception as e:
+        logger.exception(e)
+        logger.critical(f"Error <{e}> encountered while publishing catalog snapshot")
+        return catalog
+    set_catalog(mapped)
+    _loaded_version = version
+    return mapped
+
+
+def reload_catalog_snapshot() -> Optional[dict]:
+    """指针指向新版本时映射并替换本进程的谱面目录，返回随之发布的数据；没有更新时返回None"""
+    global _loaded_version
+    version = snapshot_store.current_version()
+    if version is None or version == _loaded_version:
+        return None
+    try:
+        catalog = snapshot_store.load(version)
+        state = snapshot_store.load_state(version)
+    except Exception as e:
+        logger.exception(e)
+        logger.critical(f"Error <{e}> encountered while loading catalog snapshot")
+        return None
+    set_catalog(catalog)
+    _loaded_version = version
+    logger.info(f"loaded catalog snapshot {version}")
+    return state
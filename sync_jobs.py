@@ -0,0 +1,168 @@
+import asyncio
+import time
+import uuid
+from typing import Awaitable, Callable, Dict, List, Optional
+
+from cachetools import TTLCache
+
+from exception import ServiceBusyError
+from log import logger
+from shared_cache import shared_cache
+
+JOB_RETENTION = 600  # 任务结束后保留状态的秒数
+JOB_TIMEOUT = 120  # 单个任务的最长执行秒数，超过后视为失败
+
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+
+
+class SyncJob:
+    __slots__ = (
+        "id",
+        "player_id",
+        "bind_qq",
+        "status",
+        "stage",
+        "result_url",
+        "error",
+        "created",
+        "finished",
+    )
+
+    def __init__(self, player_id: Optional[str], bind_qq: Optional[int]):
+        self.id = uuid.uuid4().hex
+        self.player_id = player_id
+        self.bind_qq = bind_qq
+        self.status = QUEUED
+        self.stage = None  # 运行中的步骤
+        self.result_url = None
+        self.error = None
+        self.created = time.time()
+        self.finished = None
+
+    @property
+    def player_key(self) -> str:
+        return f"qq:{self.bind_qq}" if self.bind_qq else f"name:{self.player_id}"
+
+    def to_dict(self) -> dict:
+        return {
+            "job_id": self.id,
+            "status": self.status,
+            "stage": self.stage,
+            "result_url": self.result_url,
+            "error": self.error,
+            "created": round(self.created, 3),
+            "finished": round(self.finished, 3) if self.finished else None,
+        }
+
+
+# 执行同步的函数：参数为任务（用于汇报进度），返回成绩的查询地址
+SyncRunner = Callable[[SyncJob], Awaitable[str]]
+
+
+class SyncJobQueue:
+    """
+    成绩同步任务队列：提交后立即返回任务id，由固定数量的协程依次执行。
+    同一玩家已有未完成的任务时直接返回该任务。
+    任务状态同时写入共享缓存（如已启用），其他worker也能查询。
+    """
+
+    def __init__(self):
+        self._jobs = TTLCache(maxsize=10000, ttl=JOB_RETENTION)
+        self._active: Dict[str, SyncJob] = {}  # player_key -> 未完成的任务
+        self._queue: Optional[asyncio.Queue] = None
+        self._workers: List[asyncio.Task] = []
+        self._runner: Optional[SyncRunner] = None
+
+    def start(self, workers: int, max_queue: int, runner: SyncRunner) -> None:
+        self._queue = asyncio.Queue(maxsize=max_queue)
+        self._runner = runner
+        self._workers = [asyncio.create_task(self._work()) for _ in range(workers)]
+
+    async def stop(self) -> None:
+        for task in self._workers:
+            task.cancel()
+        await asyncio.gather(*self._workers, return_exceptions=True)
+        self._workers = []
+
+    async def submit(self, player_id: Optional[str], bind_qq: Optional[int]) -> dict:
+        job = SyncJob(player_id, bind_qq)
+        shared = await self._shared_get(job.player_key)
+        # 读取共享状态期间可能已有同一玩家的任务提交，之后再检查本进程的任务
+        active = self._active.get(job.player_key)
+        if active is not None:
+            return active.to_dict()
+        if (
+            shared is not None
+            and shared["status"] in (QUEUED, RUNNING)
+            and shared["created"] > time.time() - JOB_TIMEOUT
+        ):
+            # 其他worker上未完成的任务（执行该任务的进程退出后不再等待）
+            return shared
+        try:
+            self._queue.put_nowait(job)
+        except asyncio.QueueFull:
+            raise ServiceBusyError("同步任务过多，请稍后重试")
+        self._active[job.player_key] = job
+        self._publish(job)
+        return job.to_dict()
+
+    async def get(self, job_id: str) -> Optional[dict]:
+        job = self._jobs.get(job_id)
+        if job is not None:
+            return job.to_dict()
+        return await self._shared_get(job_id)
+
+    def report(self, job: SyncJob, stage: str) -> None:
+        job.stage = stage
+        self._publish(job)
+
+    async def _work(self) -> None:
+        while True:
+            job = await self._queue.get()
+            job.status = RUNNING
+            self._publish(job)
+            try:
+                job.result_url = await asyncio.wait_for(self._runner(job), JOB_TIMEOUT)
+                job.status = DONE
+            except asyncio.CancelledError:
+                raise
+            except asyncio.TimeoutError:
+                job.status = FAILED
+                job.error = "同步超时，请稍后重试"
+            except Exception as e:
+                job.status = FAILED
+                job.error = getattr(e, "message", None) or "同步失败，请稍后重试"
+                logger.exception(e)
+            finally:
+                job.finished = time.time()
+                job.stage = None
+                self._active.pop(job.player_key, None)
+                self._publish(job)
+                self._queue.task_done()
+
+    def _publish(self, job: SyncJob) -> None:
+        self._jobs[job.id] = job
+        if shared_cache is None:
+            return
+        status = job.to_dict()
+        shared_cache.set_later(self._shared_key(job.id), status, JOB_RETENTION)
+        shared_cache.set_later(self._shared_key(job.player_key), status, JOB_RETENTION)
+
+    async def _shared_get(self, key: str) -> Optional[dict]:
+        if shared_cache is None:
+            return None
+        try:
+            return (await shared_cache.get(self._shared_key(key)))[1]
+        except Exception as e:
+            logger.warning(f"Error <{e}> encountered while reading sync job status")
+            return None
+
+    @staticmethod
+    def _shared_key(key: str) -> bytes:
+        return shared_cache.make_key("sync_job", key)
+
+
+sync_job_queue = SyncJobQueue()
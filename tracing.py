@@ -0,0 +1,187 @@
+import json
+import logging
+import os
+import queue
+import random
+import time
+import uuid
+from contextlib import contextmanager
+from contextvars import ContextVar
+from functools import wraps
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from typing import Dict, List, Optional
+
+
+class Span:
+    __slots__ = ("id", "parent", "name", "start", "duration", "attrs")
+
+    def __init__(self, id: int, parent: Optional[int], name: str, start: float, attrs):
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.start = start
+        self.duration = None
+        self.attrs = attrs
+
+    def to_dict(self, origin: float) -> dict:
+        span = {
+            "id": self.id,
+            "parent": self.parent,
+            "name": self.name,
+            "start_ms": round((self.start - origin) * 1000, 3),
+            "duration_ms": round(self.duration * 1000, 3)
+            if self.duration is not None
+            else None,
+        }
+        if self.attrs:
+            span["attrs"] = self.attrs
+        return span
+
+
+class Trace:
+    """
+    一次请求的追踪：trace_id总是生成，用于关联异常记录；
+    只有被采样的请求才收集span，未采样时span()几乎没有开销。
+    """
+
+    __slots__ = ("trace_id", "sampled", "time", "start", "spans")
+
+    def __init__(self, trace_id: str, sampled: bool):
+        self.trace_id = trace_id
+        self.sampled = sampled
+        self.time = time.time()
+        self.start = time.perf_counter()
+        self.spans: List[Span] = []
+
+    def server_timing(self) -> str:
+        # 按span类别（名称中冒号前的部分）汇总耗时，用于Server-Timing响应头
+        total: Dict[str, list] = {}
+        for span in self.spans:
+            if span.duration is None:
+                continue
+            category = span.name.split(":", 1)[0]
+            usage = total.setdefault(category, [0, 0.0])
+            usage[0] += 1
+            usage[1] += span.duration
+        entries = [
+            f'{name};desc="{count}";dur={duration * 1000:.3f}'
+            for name, (count, duration) in total.items()
+        ]
+        entries.append(f"total;dur={(time.perf_counter() - self.start) * 1000:.3f}")
+        return ", ".join(entries)
+
+
+_current_trace: ContextVar[Optional[Trace]] = ContextVar("current_trace", default=None)
+_current_span: ContextVar[Optional[int]] = ContextVar("current_span", default=None)
+
+
+class Tracer:
+    """按采样率追踪请求，将span树以每行一个JSON的格式写入轮转的日志文件"""
+
+    def __init__(self):
+        self.sample_rate = 0.0
+        self.server_timing = False
+        self._logger = logging.getLogger("maibot.trace")
+        self._logger.propagate = False
+        self._logger.setLevel(logging.INFO)
+        self._listener: Optional[QueueListener] = None
+
+    def start(
+        self,
+        sample_rate: float,
+        file: str,
+        max_bytes: int,
+        backup_count: int,
+        server_timing: bool,
+    ) -> None:
+        self.sample_rate = sample_rate
+        self.server_timing = server_timing
+        if sample_rate <= 0:
+            return
+        path = os.path.join(os.path.dirname(__file__), file)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        handler = RotatingFileHandler(
+            path, maxBytes=max_bytes, backupCount=backup_count, encoding="utf8"
+        )
+        handler.setFormatter(logging.Formatter("%(message)s"))
+        # 写文件在单独的线程中进行，不阻塞事件循环
+        records = queue.SimpleQueue()
+        self._logger.addHandler(QueueHandler(records))
+        self._listener = QueueListener(records, handler)
+        self._listener.start()
+
+    def stop(self) -> None:
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+        for handler in self._logger.handlers[:]:
+            self._logger.removeHandler(handler)
+
+    def begin(self) -> Trace:
+        trace = Trace(uuid.uuid4().hex, random.random() < self.sample_rate)
+        _current_trace.set(trace)
+        _current_span.set(None)
+        return trace
+
+    def finish(self, trace: Trace, **attrs) -> None:
+        if not trace.sampled:
+            return
+        line = {
+            "trace_id": trace.trace_id,
+            "time": round(trace.time, 3),
+            "duration_ms": round((time.perf_counter() - trace.start) * 1000, 3),
+            **attrs,
+            "spans": [span.to_dict(trace.start) for span in trace.spans],
+        }
+        self._logger.info(json.dumps(line, ensure_ascii=False, default=str))
+
+
+tracer = Tracer()
+
+
+def current_trace_id() -> Optional[str]:
+    trace = _current_trace.get()
+    return trace.trace_id if trace is not None else None
+
+
+@contextmanager
+def span(name: str, **attrs):
+    # 在当前请求的追踪中记录一段耗时，可以嵌套；请求之外或未采样时什么也不做
+    trace = _current_trace.get()
+    if trace is None or not trace.sampled:
+        yield
+        return
+    current = Span(
+        len(trace.spans), _current_span.get(), name, time.perf_counter(), attrs
+    )
+    trace.spans.append(current)
+    token = _current_span.set(current.id)
+    try:
+        yield
+    except BaseException as e:
+        current.attrs["error"] = type(e).__name__
+        raise
+    finally:
+        current.duration = time.perf_counter() - current.start
+        _current_span.reset(token)
+
+
+def set_span_attribute(key: str, value) -> None:
+    # 为当前span补充属性（如缓存是否命中），未采样时忽略
+    trace = _current_trace.get()
+    span_id = _current_span.get()
+    if trace is not None and trace.sampled and span_id is not None:
+        trace.spans[span_id].attrs[key] = value
+
+
+def traced(name: str):
+    # 以span记录整个异步函数的耗时
+    def decorator(func):
+        @wraps(func)
+        async def wrapped(*args, **kwargs):
+            with span(name):
+                return await func(*args, **kwargs)
+
+        return wrapped
+
+    return decorator
@@ -0,0 +1,167 @@
+import threading
+import time
+from typing import List, Optional, Set, Tuple
+
+import numpy as np
+from peewee import Tuple as SQLTuple, fn
+
+from catalog import ChartCatalog, get_catalog
+from const import *
+from database import ChartStat, ChartVoteChange, ChartVoting, song_database
+from log import logger
+
+ChartKey = Tuple[int, int]  # (song_id, level)
+RELOAD_ALL = (-1, -1)  # 写入变更记录时表示所有谱面都需要重新读取
+CHANGE_OVERLAP = 60  # 读取变更记录时多往前读的秒数，容忍提交延迟与各机器的时钟偏差
+CHANGE_RETENTION = 600  # 变更记录保留的秒数
+BATCH_SIZE = 500
+
+
+def _vote_count(vote: int):
+    # 谱面在ChartVoting中某种投票的人数，作为更新ChartStat时的关联子查询
+    voting = ChartVoting.alias()
+    return voting.select(fn.COUNT(voting.player_id)).where(
+        (voting.song_id == ChartStat.song_id)
+        & (voting.level == ChartStat.level)
+        & (voting.vote == vote)
+    )
+
+
+def _batches(keys: List[ChartKey]):
+    for i in range(0, len(keys), BATCH_SIZE):
+        yield keys[i : i + BATCH_SIZE]
+
+
+class VoteRollup:
+    """
+    谱面点赞/点踩计数的汇总管道：投票时只在内存中记下有变化的谱面，
+    定期按ChartVoting重新统计这些谱面，把总数写入ChartStat.like/dislike，
+    多个worker或全量重算同时写入时也不会重复计数；
+    同时写入变更记录，各worker据此只读回有变化的谱面，同步到内存中的谱面目录。
+    """
+
+    def __init__(self):
+        self._dirty: Set[ChartKey] = set()
+        # record在事件循环中执行，flush在调度器的线程池中执行
+        self._lock = threading.Lock()
+        self._write_lock = threading.Lock()  # 避免flush与rebuild同时更新谱面目录
+        self._reloaded_at: Optional[float] = None  # 上次读取变更记录的时间
+        self._reloaded_catalog: Optional[ChartCatalog] = None  # 目录被替换后需全量读取
+
+    def record(
+        self, song_id: int, level: int, previous: Optional[int], current: Optional[int]
+    ) -> None:
+        """previous/current为投票前后的状态，None表示未投票"""
+        if previous == current:
+            return
+        with self._lock:
+            self._dirty.add((song_id, level))
+
+    def flush(self) -> None:
+        with self._lock:
+            dirty, self._dirty = self._dirty, set()
+        with self._write_lock:
+            if dirty and not self._flush_dirty(dirty):
+                dirty = set()
+            try:
+                self._reload(dirty)
+            except Exception as e:
+                logger.warning(f"Error <{e}> encountered while reloading chart votes")
+
+    def _flush_dirty(self, dirty: Set[ChartKey]) -> bool:
+        now = time.time()
+        keys = list(dirty)
+        try:
+            with song_database.atomic():
+                for batch in _batches(keys):
+                    self._recount(batch)
+                ChartVoteChange.insert_many(
+                    [(song_id, level, now) for song_id, level in keys],
+                    fields=[
+                        ChartVoteChange.song_id,
+                        ChartVoteChange.level,
+                        ChartVoteChange.time,
+                    ],
+                ).execute()
+                ChartVoteChange.delete().where(
+                    ChartVoteChange.time < now - CHANGE_RETENTION
+                ).execute()
+            return True
+        except Exception as e:
+            # 写入失败时把谱面放回，下次再试
+            with self._lock:
+                self._dirty |= dirty
+            logger.exception(e)
+            logger.critical(f"Error <{e}> encountered while flushing chart votes")
+            return False
+
+    @staticmethod
+    def _recount(keys: Optional[List[ChartKey]] = None) -> None:
+        """按ChartVoting重新统计指定谱面（为None时为所有谱面）的点赞/点踩数"""
+        query = ChartStat.update(like=_vote_count(LIKE), dislike=_vote_count(DISLIKE))
+        if keys is not None:
+            query = query.where(SQLTuple(ChartStat.song_id, ChartStat.level).in_(keys))
+        query.execute()
+
+    def _reload(self, dirty: Set[ChartKey]) -> None:
+        # 读回本worker与其他worker近期改动过的谱面；首次读取或目录被替换时读取全部
+        catalog = get_catalog()
+        start = time.time()
+        keys = None
+        if self._reloaded_at is not None and catalog is self._reloaded_catalog:
+            keys = set(dirty)
+            keys.update(
+                ChartVoteChange.select(ChartVoteChange.song_id, ChartVoteChange.level)
+                .where(ChartVoteChange.time >= self._reloaded_at - CHANGE_OVERLAP)
+                .tuples()
+            )
+            if RELOAD_ALL in keys:
+                keys = None
+        if keys is None or keys:
+            self._load_votes(catalog, keys)
+        self._reloaded_at = start
+        self._reloaded_catalog = catalog
+
+    @staticmethod
+    def _load_votes(catalog: ChartCatalog, keys: Optional[Set[ChartKey]]) -> None:
+        query = ChartStat.select(
+            ChartStat.song_id, ChartStat.level, ChartStat.like, ChartStat.dislike
+        )
+        if keys is None:
+            rows = list(query.tuples())
+        else:
+            rows = []
+            for batch in _batches(list(keys)):
+                rows.extend(
+                    query.where(
+                        SQLTuple(ChartStat.song_id, ChartStat.level).in_(batch)
+                    ).tuples()
+                )
+        if not rows or not len(catalog):
+            return
+        values = np.array(rows, dtype=np.int64)
+        positions = catalog.indices_of(values[:, 0], values[:, 1])
+        known = positions >= 0
+        like, dislike = catalog.like.copy(), catalog.dislike.copy()
+        like[positions[known]] = values[known, 2]
+        dislike[positions[known]] = values[known, 3]
+        catalog.set_votes(like, dislike)
+
+    def rebuild(self) -> None:
+        """
+        按ChartVoting全量重算所有谱面的like/dislike。
+        会扫描整张投票表，应在线程池中调用；重算在一个事务中完成。
+        """
+        logger.info("rebuilding chart votes")
+        with self._write_lock:
+            with song_database.atomic():
+                self._recount()
+                ChartVoteChange.insert(
+                    song_id=RELOAD_ALL[0], level=RELOAD_ALL[1], time=time.time()
+                ).execute()
+            # 提交后再更新内存中的谱面目录
+            self._reloaded_at = None
+            self._reload(set())
+
+
+vote_rollup = VoteRollup()